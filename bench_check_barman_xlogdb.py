@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+#
+# Benchmark of the xlogdb read done by the last_wal_age check of
+# check_barman.py.
+#
+# A synthetic xlogdb of --lines lines is generated in a temporary directory,
+# then the time to get its last line is measured with read_last_line() and
+# with a full scan of the file, the way last_wal_age used to read it.
+#
+# Usage: bench_check_barman_xlogdb.py [--lines N] [--runs N] [--keep]
+#
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from check_barman import read_last_line
+
+
+def generate_xlogdb(path, lines):
+    # One line per 16MB WAL segment, in the format written by barman:
+    # name size time compression
+    start = int(time.time()) - lines * 60
+    with open(path, 'w') as fxlogdb:
+        batch = []
+        for i in range(lines):
+            batch.append("%08X%08X%08X 16777216 %d.0 gzip\n"
+                         % (1, i // 256, i % 256, start + i * 60))
+            if len(batch) == 100000:
+                fxlogdb.write("".join(batch))
+                batch = []
+        fxlogdb.write("".join(batch))
+
+
+def full_scan(path):
+    line = None
+    with open(path, 'r') as fxlogdb:
+        for line in fxlogdb:
+            pass
+    return line
+
+
+def tail_seek(path):
+    with open(path, 'rb') as fxlogdb:
+        return read_last_line(fxlogdb)
+
+
+def best_of(func, path, runs):
+    timings = []
+    for i in range(runs):
+        start = time.time()
+        line = func(path)
+        timings.append(time.time() - start)
+    return (min(timings), line)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark of the xlogdb read of last_wal_age.")
+    parser.add_argument('--lines', type=int, default=5000000,
+                        help="lines of the synthetic xlogdb.")
+    parser.add_argument('--runs', type=int, default=5,
+                        help="runs of each read, the best one is kept.")
+    parser.add_argument('--keep', action='store_true',
+                        help="keep the generated xlogdb.")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="xlogdb-bench-")
+    path = os.path.join(directory, "xlog.db")
+    try:
+        start = time.time()
+        generate_xlogdb(path, args.lines)
+        print("Generated %d lines (%.1f MB) in %.1fs: %s"
+              % (args.lines, os.path.getsize(path) / 1024.0 / 1024.0,
+                 time.time() - start, path))
+
+        (scan, scan_line) = best_of(full_scan, path, args.runs)
+        (seek, seek_line) = best_of(tail_seek, path, args.runs)
+        if scan_line != seek_line:
+            print("Last lines differ: %r != %r" % (scan_line, seek_line))
+            sys.exit(1)
+
+        print("full scan: %10.3f ms" % (scan * 1000))
+        print("tail seek: %10.3f ms" % (seek * 1000))
+    finally:
+        if not args.keep:
+            shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+#
+# Startup benchmark for check_mongodb.py
+#
+# Times the import of the plugin module and the first byte written by the
+# plugin for the paths that should not load pymongo: --help, an argument
+# error and a result served from the --cache-ttl cache. Interpreter startup
+# alone is measured as a baseline.
+#
+# Usage: bench_check_mongodb_startup.py [--runs N] [--python PYTHON]
+#
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+PLUGIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "check_mongodb.py")
+
+# Cached serverStatus of this host, never a real MongoDB server
+CACHE_HOST = "bench-startup.invalid"
+
+
+def first_byte(command):
+    """ Seconds from spawning command until the first byte on its stdout or stderr """
+    start = time.time()
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    proc.stdout.read(1)
+    elapsed = time.time() - start
+    proc.stdout.read()
+    proc.wait()
+    return elapsed
+
+
+def import_time(python):
+    """ Seconds spent importing the plugin module, as measured by the child interpreter """
+    code = ("import sys, time; sys.path.insert(0, %r); start = time.time(); import check_mongodb; "
+            "print(time.time() - start)" % os.path.dirname(PLUGIN))
+    return float(subprocess.check_output([python, "-c", code]).decode())
+
+
+def write_cache(python):
+    """ Write a cached serverStatus for CACHE_HOST with the plugin itself, False if bson is missing """
+    code = ("import sys, datetime; sys.path.insert(0, %r); import check_mongodb as m; "
+            "sys.exit(m.write_server_status_cache(%r, 27017, {'version': '7.0.0', 'localTime': datetime.datetime.utcnow(), "
+            "'connections': {'current': 10, 'available': 90}}))" % (os.path.dirname(PLUGIN), CACHE_HOST))
+    try:
+        return subprocess.call([python, "-c", code], stderr=subprocess.DEVNULL) == 0
+    except OSError:
+        return False
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Startup benchmark for check_mongodb.py")
+    parser.add_argument("--runs", type=int, default=20, help="runs of each case (default: 20)")
+    parser.add_argument("--python", default=sys.executable, help="interpreter running the plugin")
+    args = parser.parse_args()
+
+    cases = [
+        ("interpreter only", lambda: first_byte([args.python, "-c", "print(1)"])),
+        ("import check_mongodb", lambda: import_time(args.python)),
+        ("--help first byte", lambda: first_byte([args.python, PLUGIN, "--help"])),
+        ("argument error first byte", lambda: first_byte([args.python, PLUGIN, "-A", "no_such_action"])),
+    ]
+    if write_cache(args.python):
+        cases.append(("cached connections first byte",
+                      lambda: first_byte([args.python, PLUGIN, "-H", CACHE_HOST, "-A", "connections",
+                                          "--cache-ttl", "3600"])))
+    else:
+        print("bson is not installed, skipping the --cache-ttl case")
+
+    print("%-32s %10s %10s" % ("case", "median ms", "min ms"))
+    for name, run in cases:
+        timings = [run() for _ in range(args.runs)]
+        print("%-32s %10.1f %10.1f" % (name, median(timings) * 1000, min(timings) * 1000))
+
+
+if __name__ == "__main__":
+    main()
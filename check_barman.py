@@ -18,21 +18,46 @@
 from datetime import datetime
 import argparse
 import dateutil
+import io
+import json
 import os
 import pwd
+import queue
+import re
+import socket
 import sys
+import tempfile
+import threading
+import time
 
 OK = 0
 WARNING = 1
 CRITICAL = 2
 UNKNOWN = 3
 
+STATE_NAMES = {OK: "OK", WARNING: "WARNING", CRITICAL: "CRITICAL",
+               UNKNOWN: "UNKNOWN"}
+
+# Actions which reach the PostgreSQL server, run concurrently by sweep
+REMOTE_ACTIONS = ["ssh", "postgresql"]
+
+# When a thread sets a stream here, check output goes to it instead of stdout
+captured = threading.local()
+
+
+def output(text):
+    stream = getattr(captured, 'stream', None)
+    if stream is not None:
+        stream.write(text + "\n")
+    else:
+        print(text)
+
 
 def print_message(message, perfdata_str=None):
     if perfdata_str is not None:
-        print("%s | %s" % (message, perfdata_str))
+        output("%s | %s" % (message, perfdata_str))
     else:
-        print(message)
+        output(message)
 
 
 def get_perfdata_str(perfdata_key, perfdata_value,
@@ -70,10 +95,16 @@ def critical(message, perfdata_str=None):
 
 
 def unknown(message):
-    print("UNKNOWN - %s" % message)
+    output("UNKNOWN - %s" % message)
     raise SystemExit(UNKNOWN)
 
 
+def worst_state(state, other):
+    # CRITICAL > WARNING > UNKNOWN > OK
+    order = [OK, UNKNOWN, WARNING, CRITICAL]
+    return max(state, other, key=order.index)
+
+
 def exit_check(value, warn, crit, message, under=False, message_ok=None,
                perfdata_key=None, perfdata_min=None, perfdata_max=None):
 
@@ -112,6 +143,34 @@ def timed(function, *args, **kwargs):
     return (retval, end - start)
 
 
+def load_state(server, args, name):
+    path = os.path.join(args.state_dir,
+                        "%s.%s.json" % (server.config.name, name))
+
+    try:
+        with open(path) as fstate:
+            return json.load(fstate)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def save_state(server, args, name, state):
+    path = os.path.join(args.state_dir,
+                        "%s.%s.json" % (server.config.name, name))
+
+    # Write to a temporary file first so that a concurrent run never reads a
+    # partial state. Failing to save only costs a full scan on the next run.
+    try:
+        if not os.path.isdir(args.state_dir):
+            os.makedirs(args.state_dir)
+        with tempfile.NamedTemporaryFile('w', dir=args.state_dir,
+                                         delete=False) as fstate:
+            json.dump(state, fstate)
+        os.rename(fstate.name, path)
+    except (IOError, OSError):
+        pass
+
+
 def ssh(server, args):
     warn = args.warning
     crit = args.critical
@@ -168,6 +227,44 @@ def postgresql(server, args):
                perfdata_key=perfdata_key, perfdata_min=0)
 
 
+def get_backup_index(server, args):
+    from barman.infofile import BackupInfo
+    try:
+        # barman >= 2.10 reads backup.info files through LocalBackupInfo
+        from barman.infofile import LocalBackupInfo
+    except ImportError:
+        LocalBackupInfo = BackupInfo
+
+    def index_entry(backup):
+        end_time = backup.end_time
+        return {'status': backup.status,
+                'begin_time': backup.begin_time.timestamp()
+                if backup.begin_time else None,
+                'end_time': end_time.timestamp() if end_time else None,
+                'size': backup.size}
+
+    # Adding or removing a backup changes the mtime of the base backups
+    # directory, only then are all the backup.info files parsed again.
+    mtime = os.stat(server.config.basebackups_directory).st_mtime_ns
+    index = load_state(server, args, "backups")
+
+    if index is None or index['mtime'] != mtime:
+        backups = server.get_available_backups(BackupInfo.STATUS_ALL)
+        index = {'mtime': mtime,
+                 'backups': dict((backup_id, index_entry(backup))
+                                 for (backup_id, backup) in backups.items())}
+    else:
+        # A running backup only rewrites its own backup.info
+        for (backup_id, entry) in index['backups'].items():
+            if entry['status'] not in (BackupInfo.DONE, BackupInfo.FAILED):
+                backup = LocalBackupInfo(server, backup_id=backup_id)
+                index['backups'][backup_id] = index_entry(backup)
+
+    save_state(server, args, "backups", index)
+
+    return index['backups']
+
+
 def backups_available(server, args):
     warn = args.warning
     crit = args.critical
@@ -175,8 +272,9 @@ def backups_available(server, args):
     from barman.infofile import BackupInfo
     status_filter = BackupInfo.STATUS_NOT_EMPTY
 
-    backups = server.get_available_backups(status_filter)
-    nb_backups = len(backups)
+    backups = get_backup_index(server, args)
+    nb_backups = len([entry for entry in backups.values()
+                      if entry['status'] in status_filter])
 
     exit_check(nb_backups, warn, crit,
                "Only %d backups available." % nb_backups,
@@ -190,13 +288,16 @@ def last_backup_age(server, args):
 
     from barman.infofile import BackupInfo
 
-    backup_id = server.get_last_backup()
+    # Backup ids are timestamps, the last one sorts last
+    backups = get_backup_index(server, args)
+    done = sorted(backup_id for (backup_id, entry) in backups.items()
+                  if entry['status'] == BackupInfo.DONE)
 
-    status_filter = BackupInfo.STATUS_NOT_EMPTY
-    backups = server.get_available_backups(status_filter)
+    if not done:
+        critical("No backup available.")
 
-    backup = backups[backup_id]
-    begin_time = backup.begin_time
+    begin_time = datetime.fromtimestamp(backups[done[-1]]['begin_time'],
+                                        dateutil.tz.tzlocal())
     now = datetime.now().replace(tzinfo=dateutil.tz.tzlocal())
 
     age = now - begin_time
@@ -207,6 +308,30 @@ def last_backup_age(server, args):
                perfdata_key="hours", perfdata_min=0)
 
 
+def read_last_line(fobj, block_size=8192):
+    # Read blocks backwards from the end of the file until the last complete
+    # line is found, so that the cost does not depend on the file size.
+    fobj.seek(0, os.SEEK_END)
+    position = fobj.tell()
+    data = b''
+
+    while position > 0:
+        step = min(block_size, position)
+        position = position - step
+        fobj.seek(position)
+        data = fobj.read(step) + data
+
+        end = data.rfind(b'\n')
+        if end < 0:
+            continue
+
+        start = data.rfind(b'\n', 0, end) + 1
+        if start > 0 or position == 0:
+            return data[start:end + 1].decode()
+
+    return None
+
+
 def last_wal_age(server, args):
     warn = args.warning
     crit = args.critical
@@ -214,9 +339,8 @@ def last_wal_age(server, args):
     from barman.infofile import WalFileInfo
 
     with server.xlogdb() as fxlogdb:
-        line = None
-        for line in fxlogdb:
-            pass
+        with open(fxlogdb.name, 'rb') as fxlogdb_raw:
+            line = read_last_line(fxlogdb_raw)
 
         if line is None:
             critical("No WAL received yet.")
@@ -240,10 +364,10 @@ def failed_backups(server, args):
     crit = args.critical
 
     from barman.infofile import BackupInfo
-    status_filter = BackupInfo.FAILED
 
-    backups = server.get_available_backups(status_filter)
-    nb_backups = len(backups)
+    backups = get_backup_index(server, args)
+    nb_backups = len([entry for entry in backups.values()
+                      if entry['status'] == BackupInfo.FAILED])
 
     exit_check(nb_backups, warn, crit, "%d backups failed." % nb_backups,
                perfdata_key="backups", perfdata_min=0)
@@ -254,23 +378,98 @@ def missing_wals(server, args):
     crit = args.critical
 
     from barman.xlog import is_wal_file
-    from barman.infofile import WalFileInfo
 
     wals_directory = server.config.wals_directory
 
-    missing_wals = 0
-    with server.xlogdb() as fxlogdb:
-        for line in fxlogdb:
-            #name, size, time, compression = server.xlogdb_parse_line(line)
-            wal_info = WalFileInfo.from_xlogdb_line(line)
-            name = wal_info.name
+    # Each WAL directory is listed at most once per run
+    listings = {}
+
+    def listing(directory):
+        if directory not in listings:
+            path = os.path.join(wals_directory, directory)
+            try:
+                mtime = os.stat(path).st_mtime_ns
+                with os.scandir(path) as entries:
+                    listings[directory] = (mtime, set(e.name for e in entries))
+            except (IOError, OSError):
+                listings[directory] = (None, set())
+        return listings[directory]
+
+    def dir_mtime(directory):
+        try:
+            return os.stat(os.path.join(wals_directory, directory)).st_mtime_ns
+        except (IOError, OSError):
+            return None
+
+    def count_missing(lines, directory):
+        names = listing(directory)[1]
+        missing = 0
+        for line in lines:
+            name = line.split(None, 1)[0].decode()
+            if name[0:16] == directory and is_wal_file(name) \
+                    and name not in names:
+                missing = missing + 1
+        return missing
+
+    # The checkpoint holds the verified part of the xlogdb and, for each WAL
+    # directory, its mtime, the byte range of its lines and its missing count.
+    state = load_state(server, args, "missing_wals")
 
-            directory = name[0:16]
-
-            if is_wal_file(name):
-                file_path = os.path.join(wals_directory, directory, name)
-                if not os.path.exists(file_path):
-                    missing_wals = missing_wals + 1
+    with server.xlogdb() as fxlogdb:
+        with open(fxlogdb.name, 'rb') as fxlogdb_raw:
+            stat = os.fstat(fxlogdb_raw.fileno())
+            first_line = fxlogdb_raw.readline().decode()
+
+            # Start over when the xlogdb has been rebuilt or rewritten
+            if state is None or state['inode'] != stat.st_ino \
+                    or state['offset'] > stat.st_size \
+                    or state['first_line'] != first_line:
+                state = {'inode': stat.st_ino, 'offset': 0,
+                         'first_line': first_line, 'directories': {}}
+
+            directories = state['directories']
+
+            # Verify again the lines of directories changed since last run
+            for directory, entry in directories.items():
+                mtime = dir_mtime(directory)
+                if mtime != entry['mtime']:
+                    fxlogdb_raw.seek(entry['start'])
+                    data = fxlogdb_raw.read(entry['end'] - entry['start'])
+                    entry['missing'] = count_missing(data.splitlines(),
+                                                     directory)
+                    entry['mtime'] = listing(directory)[0]
+
+            # Verify the lines appended since last run
+            offset = state['offset']
+            fxlogdb_raw.seek(offset)
+            for line in fxlogdb_raw:
+                if not line.endswith(b'\n'):
+                    # Line still being written, keep it for next run
+                    break
+
+                start = offset
+                offset = offset + len(line)
+
+                name = line.split(None, 1)[0].decode()
+                if not is_wal_file(name):
+                    continue
+
+                directory = name[0:16]
+                if directory not in directories:
+                    directories[directory] = {'mtime': listing(directory)[0],
+                                              'start': start, 'end': offset,
+                                              'missing': 0}
+
+                entry = directories[directory]
+                entry['end'] = offset
+                if name not in listing(directory)[1]:
+                    entry['missing'] = entry['missing'] + 1
+
+            state['offset'] = offset
+
+    save_state(server, args, "missing_wals", state)
+
+    missing_wals = sum(entry['missing'] for entry in directories.values())
 
     exit_check(missing_wals, warn, crit,
                "There are %d missing wals for the last backup." % missing_wals,
@@ -292,6 +491,158 @@ ACTIONS = {
 }
 
 
+def run_captured(action, server, args):
+    captured.stream = io.StringIO()
+    try:
+        action(server, args)
+        code = UNKNOWN
+        output("UNKNOWN - The check returned no result.")
+    except SystemExit as e:
+        code = e.code
+    except Exception as e:
+        code = UNKNOWN
+        output("UNKNOWN - %s" % e)
+    finally:
+        text = captured.stream.getvalue().strip()
+        captured.stream = None
+
+    return (code, text)
+
+
+def run_remote_probes(probes, results, workers, timeout):
+    # Threads cannot be killed, so a probe which times out is reported as
+    # UNKNOWN and left behind as a daemon thread; its late result is ignored.
+    done = queue.Queue()
+    pending = list(probes)
+    running = {}
+
+    def probe(key, action, server, args):
+        done.put((key, run_captured(action, server, args)))
+
+    while pending or running:
+        while pending and len(running) < workers:
+            (key, action, server, args) = pending.pop(0)
+            thread = threading.Thread(target=probe,
+                                      args=(key, action, server, args))
+            thread.daemon = True
+            thread.start()
+            running[key] = time.time() + timeout
+
+        try:
+            wait = max(0, min(running.values()) - time.time())
+            (key, result) = done.get(timeout=wait)
+            if key in running:
+                del running[key]
+                results[key] = result
+        except queue.Empty:
+            now = time.time()
+            for key, deadline in list(running.items()):
+                if deadline <= now:
+                    del running[key]
+                    results[key] = (UNKNOWN, "UNKNOWN - Timed out after %ss."
+                                    % timeout)
+
+
+def parse_thresholds(thresholds):
+    # ACTION:W:C, either threshold may be left empty
+    parsed = {}
+    for threshold in thresholds:
+        try:
+            (action, warn, crit) = threshold.split(":")
+            parsed[action] = (int(warn) if warn else None,
+                              int(crit) if crit else None)
+        except ValueError:
+            unknown("Invalid threshold %s, expected ACTION:W:C." % threshold)
+    return parsed
+
+
+def sweep(config, args):
+    from barman.server import Server
+
+    actions = args.actions.split(",")
+    for action in actions:
+        if action not in ACTIONS or action == "sweep":
+            unknown("The action %s does not exist." % action)
+
+    thresholds = parse_thresholds(args.thresholds)
+
+    def action_args(action):
+        action_args = argparse.Namespace(**vars(args))
+        (action_args.warning, action_args.critical) = \
+            thresholds.get(action, (None, None))
+        return action_args
+
+    servers = []
+    results = {}
+    for server_config in sorted(config.servers(), key=lambda c: c.name):
+        try:
+            servers.append((server_config.name, Server(server_config)))
+        except Exception as e:
+            for action in actions:
+                results[(server_config.name, action)] = \
+                    (UNKNOWN, "UNKNOWN - %s" % e)
+            servers.append((server_config.name, None))
+
+    # Remote probes run in the background while local checks read the disk
+    probes = [((name, action), ACTIONS[action][0], server, action_args(action))
+              for (name, server) in servers if server is not None
+              for action in actions if action in REMOTE_ACTIONS]
+    remote = threading.Thread(target=run_remote_probes,
+                              args=(probes, results, args.workers,
+                                    args.timeout))
+    remote.start()
+
+    for (name, server) in servers:
+        if server is None:
+            continue
+        for action in actions:
+            if action not in REMOTE_ACTIONS:
+                results[(name, action)] = run_captured(ACTIONS[action][0],
+                                                       server,
+                                                       action_args(action))
+
+    remote.join()
+
+    state = OK
+    counts = dict((code, 0) for code in STATE_NAMES)
+    lines = []
+    perfdata = []
+    commands = []
+    now = int(time.time())
+    for (name, server) in servers:
+        for action in actions:
+            (code, text) = results[(name, action)]
+            if code not in STATE_NAMES:
+                code = UNKNOWN
+            state = worst_state(state, code)
+            counts[code] = counts[code] + 1
+            # Perfdata only belongs on the first line of the output, so it
+            # is gathered there with the server and action in its labels
+            (summary, _, perf) = text.partition(" | ")
+            lines.append("%s %s: %s" % (name, action, summary))
+            prefix = re.sub(r'\W', '_', "%s_%s_" % (name, action))
+            perfdata += [prefix + item for item in perf.split()]
+
+            service = args.service_name % {'server': name, 'action': action}
+            commands.append("[%d] PROCESS_SERVICE_CHECK_RESULT;%s;%s;%d;%s\n"
+                            % (now, args.host_name, service, code,
+                               text.replace("\n", " ")))
+
+    if args.command_file:
+        with open(args.command_file, 'a') as fcommand:
+            fcommand.write("".join(commands))
+
+    message = "%d checks on %d servers, %d critical, %d warning, " \
+        "%d unknown." % (len(lines), len(servers), counts[CRITICAL],
+                         counts[WARNING], counts[UNKNOWN])
+    if perfdata:
+        message += " | " + " ".join(perfdata)
+    message += "\n" + "\n".join(lines)
+
+    {OK: ok, WARNING: warning, CRITICAL: critical, UNKNOWN: unknown}[state](
+        message)
+
+
 def main():
     parser = argparse.ArgumentParser(description="Barman plugin for NRPE.")
     parser.add_argument("-s", "--server", dest="server",
@@ -304,6 +655,10 @@ def main():
                         help="user needed to run this script. If the "
                         "current user is not this one, the script will try " +
                         "to rerun itself using sudo.")
+    parser.add_argument('--state-dir', dest='state_dir', metavar='DIR',
+                        default='/var/tmp/check_barman',
+                        help="directory where checks keep their state "
+                        "between runs.")
 
     subparsers = parser.add_subparsers()
 
@@ -312,6 +667,34 @@ def main():
         subparser = subparsers.add_parser(key, help=help)
         subparser.set_defaults(action=action)
 
+    subparser = subparsers.add_parser(
+        "sweep", help="Run actions on all configured servers at once.")
+    subparser.add_argument('--actions', dest='actions', metavar='A1,A2',
+                           default=",".join(ACTIONS),
+                           help="comma separated actions to run, all by "
+                           "default.")
+    subparser.add_argument('--threshold', dest='thresholds', action='append',
+                           metavar='ACTION:W:C', default=[],
+                           help="thresholds of an action, may be repeated.")
+    subparser.add_argument('--timeout', type=int, dest='timeout', default=30,
+                           help="timeout of each ssh and postgresql probe, "
+                           "in seconds.")
+    subparser.add_argument('--workers', type=int, dest='workers', default=8,
+                           help="number of concurrent ssh and postgresql "
+                           "probes.")
+    subparser.add_argument('--command-file', dest='command_file',
+                           metavar='FILE',
+                           help="also write the results as "
+                           "PROCESS_SERVICE_CHECK_RESULT commands to FILE.")
+    subparser.add_argument('--host-name', dest='host_name',
+                           default=socket.gethostname(),
+                           help="host name of the submitted results.")
+    subparser.add_argument('--service-name', dest='service_name',
+                           default="barman_%(server)s_%(action)s",
+                           help="service name format of the submitted "
+                           "results.")
+    subparser.set_defaults(action=sweep)
+
     parser.error = unknown
 
     args = parser.parse_args()
@@ -329,6 +712,10 @@ def main():
 
     config = Config()
     config.load_configuration_files_directory()
+
+    if args.action == sweep:
+        sweep(config, args)
+
     server = Server(config.get_server(args.server))
 
     try:
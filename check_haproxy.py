@@ -13,67 +13,125 @@
 """
 
 import sys
-import socket
+import os
 import time
+import fcntl
+import re
+import json
+import socket
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from operator import attrgetter, itemgetter
 from argparse import ArgumentParser, Namespace as Arguments
 import argparse
 
 
+# Size of the receive buffer for socket replies
+RECV_BUFSIZE = 256 * 1024
+
+# Type bitmasks of the "show stat <iid> <type> <sid>" filter
+STAT_TYPE_FRONTEND = 1
+STAT_TYPE_BACKEND = 2
+STAT_TYPE_SERVER = 4
+
+# Counters summed when merging processes
+SUMMED_FIELDS = ['sessions', 'sessionstotal', 'queue', 'bytein', 'byteout',
+                 'requesterrors', 'connecterrors', 'responseerrors']
+
+# Lifetime counters reported as per second rates with --rates, and their perfdata labels
+RATE_LABELS = {'sessionstotal': 'session_rate', 'bytein': 'bytein_rate', 'byteout': 'byteout_rate',
+               'requesterrors': 'ereq_rate', 'connecterrors': 'econ_rate', 'responseerrors': 'eresp_rate'}
+FRONTEND_RATES = ['sessionstotal', 'bytein', 'byteout', 'requesterrors']
+BACKEND_RATES = ['sessionstotal', 'bytein', 'byteout', 'connecterrors', 'responseerrors']
+
+# Counters of objects not seen for this long are dropped from the state file
+RATES_MAX_AGE = 86400
+
+
 class HaproxyFrontend:
     """ Class for haproxy frontend object """
-    # pylint: disable=too-few-public-methods
-
-    def __init__(self):
-        self.name: str = None
-        self.state: str = None
-        self.sessions: int = None
-        self.sessionlimit: int = None
-        self.bytein: int = None
-        self.byteout: int = None
+    # pylint: disable=too-few-public-methods,too-many-instance-attributes,too-many-arguments
+    __slots__ = ('name', 'state', 'sessions', 'sessionlimit', 'sessionstotal', 'bytein', 'byteout',
+                 'requesterrors')
+
+    def __init__(self, name=None, state=None, sessions=None, sessionlimit=None, sessionstotal=None,
+                 bytein=None, byteout=None, requesterrors=None):
+        self.name: str = name
+        self.state: str = state
+        self.sessions: int = sessions
+        self.sessionlimit: int = sessionlimit
+        self.sessionstotal: int = sessionstotal
+        self.bytein: int = bytein
+        self.byteout: int = byteout
+        self.requesterrors: int = requesterrors
 
 
 class HaproxyBackend:
     """ Class for haproxy backend object """
-    # pylint: disable=too-few-public-methods
-
-    def __init__(self):
-        self.name: str = None
-        self.state: str = None
-        self.sessions: int = None
-        self.sessionlimit: int = None
-        self.bytein: int = None
-        self.byteout: int = None
+    # pylint: disable=too-few-public-methods,too-many-instance-attributes,too-many-arguments
+    __slots__ = ('name', 'state', 'sessions', 'sessionlimit', 'sessionstotal', 'queue', 'bytein', 'byteout',
+                 'connecterrors', 'responseerrors')
+
+    def __init__(self, name=None, state=None, sessions=None, sessionlimit=None, sessionstotal=None,
+                 queue=None, bytein=None, byteout=None, connecterrors=None, responseerrors=None):
+        self.name: str = name
+        self.state: str = state
+        self.sessions: int = sessions
+        self.sessionlimit: int = sessionlimit
+        self.sessionstotal: int = sessionstotal
+        self.queue: int = queue
+        self.bytein: int = bytein
+        self.byteout: int = byteout
+        self.connecterrors: int = connecterrors
+        self.responseerrors: int = responseerrors
 
 
 class HaproxyServer:
     """ Class for haproxy server object """
-    # pylint: disable=too-few-public-methods,too-many-instance-attributes
-
-    def __init__(self):
-        self.name: str = None
-        self.backend: str = None
-        self.state: str = None
-        self.sessions: int = None
-        self.sessionlimit: int = None
-        self.sessionstotal: int = None
-        self.queue: int = None
-        self.bytein: int = None
-        self.byteout: int = None
+    # pylint: disable=too-few-public-methods,too-many-instance-attributes,too-many-arguments
+    __slots__ = ('name', 'backend', 'state', 'sessions', 'sessionlimit', 'sessionstotal', 'queue',
+                 'queuelimit', 'bytein', 'byteout', 'connecterrors', 'responseerrors')
+
+    def __init__(self, name=None, backend=None, state=None, sessions=None, sessionlimit=None,
+                 sessionstotal=None, queue=None, queuelimit=None, bytein=None, byteout=None,
+                 connecterrors=None, responseerrors=None):
+        self.name: str = name
+        self.backend: str = backend
+        self.state: str = state
+        self.sessions: int = sessions
+        self.sessionlimit: int = sessionlimit
+        self.sessionstotal: int = sessionstotal
+        self.queue: int = queue
+        self.queuelimit: int = queuelimit
+        self.bytein: int = bytein
+        self.byteout: int = byteout
+        self.connecterrors: int = connecterrors
+        self.responseerrors: int = responseerrors
 
 
 def get_args():
     """ Parse Arguments """
     parser = ArgumentParser(description="Icinga/Nagios plugin which checks a haproxy load balancer")
 
-    parser.add_argument("--socketfile", required=False,
-                        help="Location of haproxy stats socket file",
+    parser.add_argument("--socketfile", required=False, nargs="+",
+                        help="Location of haproxy stats socket file(s), queried concurrently and merged",
                         type=str, dest='socketfile',
-                        default="/run/haproxy/admin.sock")
+                        default=["/run/haproxy/admin.sock"])
+    parser.add_argument("--master", required=False, action="store_true",
+                        help="Socket files are master CLI sockets, query every current worker through them",
+                        dest='master')
     parser.add_argument("--mode", required=False, type=str, dest="mode",
-                        default="instance", choices=["instance", "frontend"],
+                        default="instance", choices=["instance", "frontend", "backend", "server"],
                         help="Plugin mode")
     parser.add_argument("--perfdata", action=argparse.BooleanOptionalAction,
                         help="Enable/Disable perfdata")
+    parser.add_argument("--rates", required=False, action="store_true",
+                        help="Add per second session, byte and error rates since the previous run to perfdata",
+                        dest='rates')
+    parser.add_argument("--statedir", required=False,
+                        help="Directory for the proxy id cache and the counters of --rates",
+                        type=str, dest='statedir',
+                        default="/var/tmp/check_haproxy")
 
     thresholds = parser.add_argument_group('Thresholds')
     thresholds.add_argument("--slimwarn", required=False,
@@ -82,23 +140,53 @@ def get_args():
     thresholds.add_argument("--slimcrit", required=False,
                             help="Exit CRIT if sessions reach <slimcrit>%% of session limit",
                             type=int, dest='slim_crit', default=90)
+    thresholds.add_argument("--qlimwarn", required=False,
+                            help="Exit WARN if a server queue reaches <qlimwarn>%% of its queue limit",
+                            type=int, dest='qlim_warn', default=80)
+    thresholds.add_argument("--qlimcrit", required=False,
+                            help="Exit CRIT if a server queue reaches <qlimcrit>%% of its queue limit",
+                            type=int, dest='qlim_crit', default=90)
+    thresholds.add_argument("--upwarn", required=False,
+                            help="Exit WARN if less than <upwarn>%% of the servers of a backend are up",
+                            type=int, dest='up_warn', default=100)
+    thresholds.add_argument("--upcrit", required=False,
+                            help="Exit CRIT if less than <upcrit>%% of the servers of a backend are up",
+                            type=int, dest='up_crit', default=50)
 
     modeargs = parser.add_argument_group('Mode-specific arguments')
-    modeargs.add_argument("--frontend", required=False, default=None,
-                          help="Name of frontend to check (only with \"--mode frontend\")",
+    modeargs.add_argument("--frontend", required=False, default=None, nargs="+",
+                          help="Name(s) of frontends to check (only with \"--mode frontend\")",
                           type=str, dest="frontend")
+    modeargs.add_argument("--backend", required=False, default=None, nargs="+",
+                          help="Name(s) of backends to check (only with \"--mode backend\")",
+                          type=str, dest="backend")
+    modeargs.add_argument("--server", required=False, default=None, nargs="+",
+                          help="Server(s) to check as <backend>/<server> (only with \"--mode server\")",
+                          type=str, dest="server")
 
     args = parser.parse_args()
 
     # Validate arguments
-    if args.frontend is not None and args.mode != "frontend":
-        exit_plugin(3, '--frontend only works with --mode frontend', '')
+    for mode in ["frontend", "backend", "server"]:
+        if getattr(args, mode) is not None and args.mode != mode:
+            exit_plugin(3, f'--{ mode } only works with --mode { mode }', '')
+        if getattr(args, mode) is None and args.mode == mode:
+            exit_plugin(3, f'--mode { mode } requires --{ mode }', '')
+
+    if args.server is not None and not all("/" in server for server in args.server):
+        exit_plugin(3, '--server must be given as <backend>/<server>', '')
 
     if (args.slim_warn is not None
             and args.slim_crit is not None
             and args.slim_warn > args.slim_crit):
         exit_plugin(3, '--slimcrit must be higher than --slimwarn', '')
 
+    if args.qlim_warn > args.qlim_crit:
+        exit_plugin(3, '--qlimcrit must be higher than --qlimwarn', '')
+
+    if args.up_warn < args.up_crit:
+        exit_plugin(3, '--upcrit must be lower than --upwarn', '')
+
     return args
 
 
@@ -121,11 +209,12 @@ def exit_plugin(returncode: int, output: str, perfdata: str):
 def set_state(newstate: int, state: int):
     """ Set return state of plugin """
 
-    if (newstate == 2) or (state == 2):
+    # Keep the worst of both states: CRITICAL > WARNING > UNKNOWN > OK
+    if 2 in [newstate, state]:
         returnstate = 2
-    elif (newstate == 1) and (state not in [2]):
+    elif 1 in [newstate, state]:
         returnstate = 1
-    elif (newstate == 3) and (state not in [1, 2]):
+    elif 3 in [newstate, state]:
         returnstate = 3
     else:
         returnstate = 0
@@ -133,33 +222,35 @@ def set_state(newstate: int, state: int):
     return returnstate
 
 
-def haproxy_cmd(cmd: str, socketfile: str):
-    """ send cmd to haproxy socket and return reply as str """
+def haproxy_cmd_lines(cmd: str, socketfile: str):
+    """ send cmd to haproxy socket and yield the reply line by line as it arrives """
 
     try:
         # Open connection to haproxy socket
         sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
         sock.connect(socketfile)
 
-        # Send command
-        sock.sendall(cmd.encode("ascii"))
-        time.sleep(0.1)
-
-        # Shut down sending
-        sock.shutdown(socket.SHUT_WR)
+        with sock:
+            # Send command and shut down sending, haproxy answers and closes the connection
+            sock.sendall(cmd.encode("ascii"))
+            sock.shutdown(socket.SHUT_WR)
 
-        # Create buffer for receiving
-        buf = ""
+            # Receive in large chunks, only the last incomplete line is carried over
+            buf = bytearray(RECV_BUFSIZE)
+            view = memoryview(buf)
+            pending = b""
 
-        while True:
-            # Write reply to buffer in chunks of 1024 bytes
-            data = sock.recv(1024)
-            if not data:
-                break
-            buf += data.decode()
+            while True:
+                nbytes = sock.recv_into(buf)
+                if not nbytes:
+                    break
+                lines = (pending + view[:nbytes]).split(b"\n")
+                pending = lines.pop()
+                for line in lines:
+                    yield line.decode()
 
-        # Close socket connection
-        sock.close()
+            if pending:
+                yield pending.decode()
 
     except FileNotFoundError:
         exit_plugin(3, f'Socket file { socketfile } not found!', "")
@@ -170,230 +261,526 @@ def haproxy_cmd(cmd: str, socketfile: str):
     except ConnectionError as err:
         exit_plugin(3, f'Error during socket connection: { err }', "")
 
-    return buf
 
+def get_stat_columns(lines, items: list, socketfile: str):
+    """ Read the "show stat" header line and return the column number of each item """
 
-def get_haproxy_stats(socketfile: str):
-    """ Execute haproxy "show stat" command and return reply as dict """
+    # Extract column names from first line
+    header = next(lines, None)
+    if not header:
+        exit_plugin(3, f'Empty reply to "show stat" on { socketfile }', '')
+    columns = header.split(",")
 
-    resp = haproxy_cmd("show stat \n ", socketfile)
+    col_nr = {}
+    for item in items:
+        try:
+            col_nr[item] = columns.index(item)
+        except ValueError:
+            exit_plugin(3, f'Column { item } missing in "show stat" reply on { socketfile }', '')
 
-    # Initialize return object
-    stats = {}
+    return col_nr
 
-    # Extract column names from first line
-    stats["columns"] = resp.splitlines()[0].split(",")
 
-    # Initiate list for rows
-    stats["values"] = []
+def get_haproxy_stats(socketfile: str, statfilter: str = "", route: str = ""):
+    """ Execute haproxy "show stat [<iid> <type> <sid>]" command and return frontends, backends and servers """
 
-    # Write values to dict
-    for line in resp.splitlines()[1:]:
-        if line != "":
-            stats["values"].append(line.split(","))
+    lines = haproxy_cmd_lines(f"{ route }show stat { statfilter }\n", socketfile)
+
+    # Get column numbers of values
+    items = ['# pxname', 'svname', 'status', 'scur', 'slim', 'stot', 'qcur', 'qlimit', 'bin', 'bout',
+             'ereq', 'econ', 'eresp']
+    col_nr = get_stat_columns(lines, items, socketfile)
+
+    # Only split a row up to the last column we need and pick the values in one call
+    maxsplit = max(col_nr.values()) + 1
+    getter = itemgetter(*[col_nr[item] for item in items])
 
     # Initiate lists for objects of type HaproxyFrontend, HaproxyBackend and HaproxyServer
     frontends = []
     backends = []
     servers = []
 
-    # Get column numbers of values
-    col_nr = {}
-    for item in ['# pxname', 'svname', 'status', 'scur', 'slim', 'stot', 'qcur', 'bin', 'bout']:
-        col_nr[item] = stats["columns"].index(item)
-
-    # Loop through returned rows
-    for row in stats["values"]:
-
-        if row[col_nr['svname']] == "FRONTEND":
-            obj = HaproxyFrontend()
-            obj.name = row[col_nr['# pxname']]
-            obj.state = row[col_nr['status']]
-            obj.sessions = int(row[col_nr['scur']])
-            obj.bytein = int(row[col_nr['bin']])
-            obj.byteout = int(row[col_nr['bout']])
-            try:
-                obj.sessionlimit = int(row[col_nr['slim']])
-            except ValueError:
-                obj.sessionlimit = None
-
-            frontends.append(obj)
-
-        elif row[col_nr['svname']] == "BACKEND":
-            obj = HaproxyBackend()
-            obj.name = row[col_nr['# pxname']]
-            obj.state = row[col_nr['status']]
-            obj.sessions = int(row[col_nr['scur']])
-            obj.bytein = int(row[col_nr['bin']])
-            obj.byteout = int(row[col_nr['bout']])
-            try:
-                obj.sessionlimit = int(row[col_nr['slim']])
-            except ValueError:
-                obj.sessionlimit = None
+    # Parse rows as they are received
+    for line in lines:
+        if line == "":
+            continue
+        (pxname, svname, status, scur, slim, stot, qcur, qlimit, bytein, byteout,
+         ereq, econ, eresp) = getter(line.split(",", maxsplit))
+        sessionlimit = int(slim) if slim else None
+
+        if svname == "FRONTEND":
+            frontends.append(HaproxyFrontend(pxname, status, int(scur), sessionlimit, int(stot),
+                                             int(bytein), int(byteout), int(ereq or 0)))
 
-            backends.append(obj)
+        elif svname == "BACKEND":
+            backends.append(HaproxyBackend(pxname, status, int(scur), sessionlimit, int(stot), int(qcur),
+                                           int(bytein), int(byteout), int(econ or 0), int(eresp or 0)))
 
         else:
-            obj = HaproxyServer()
-            obj.name = row[col_nr['svname']]
-            obj.state = row[col_nr['status']]
-            obj.sessions = int(row[col_nr['scur']])
-            obj.bytein = int(row[col_nr['bin']])
-            obj.byteout = int(row[col_nr['bout']])
-            try:
-                obj.sessionlimit = int(row[col_nr['slim']])
-            except ValueError:
-                obj.sessionlimit = None
-            obj.sessionstotal = int(row[col_nr['stot']])
-            obj.queue = int(row[col_nr['qcur']])
+            servers.append(HaproxyServer(svname, pxname, status, int(scur), sessionlimit, int(stot), int(qcur),
+                                         int(qlimit) if qlimit else None, int(bytein), int(byteout),
+                                         int(econ or 0), int(eresp or 0)))
+
+    return frontends, backends, servers
+
+
+def get_worker_routes(socketfile: str):
+    """ Return the master CLI "@!<pid> " routing prefixes of the current workers """
+
+    routes = []
+    section = None
+
+    # "show proc" lists the master, then the sections "# workers", "# old workers" and "# programs"
+    for line in haproxy_cmd_lines("show proc\n", socketfile):
+        if line.startswith("#"):
+            section = line
+        elif line != "" and section == "# workers":
+            routes.append(f'@!{ line.split()[0] } ')
+
+    if not routes:
+        exit_plugin(3, f'No workers found on master socket { socketfile }', '')
+
+    return routes
+
+
+def get_stat_targets(args: Arguments):
+    """ Return the (socketfile, route) pairs to query """
 
-            servers.append(obj)
+    if not args.master:
+        return [(socketfile, "") for socketfile in args.socketfile]
+
+    targets = []
+    for socketfile in args.socketfile:
+        targets += [(socketfile, route) for route in get_worker_routes(socketfile)]
+
+    return targets
+
+
+def state_rank(state: str):
+    """ Rank an object state for merging, higher is worse """
+
+    if state in ["OPEN", "UP", 'no check']:
+        return 0
+    if state.startswith('UP'):
+        # Transitional states like "UP 1/3"
+        return 1
+    return 2
+
+
+def merge_stats(results: list):
+    """ Merge the frontends, backends and servers of several processes into one set """
+
+    merged = {}
+
+    for frontends, backends, servers in results:
+        for obj in frontends + backends + servers:
+            key = (type(obj), getattr(obj, "backend", None), obj.name)
+            if key not in merged:
+                merged[key] = obj
+                continue
+
+            total = merged[key]
+            for field in SUMMED_FIELDS:
+                if field in obj.__slots__:
+                    setattr(total, field, getattr(total, field) + getattr(obj, field))
+            for field in ['sessionlimit', 'queuelimit']:
+                # Limits are optional, only servers carry a queue limit
+                if field in obj.__slots__ and getattr(obj, field) is not None:
+                    setattr(total, field, (getattr(total, field) or 0) + getattr(obj, field))
+            if state_rank(obj.state) > state_rank(total.state):
+                total.state = obj.state
+
+    frontends = [obj for obj in merged.values() if isinstance(obj, HaproxyFrontend)]
+    backends = [obj for obj in merged.values() if isinstance(obj, HaproxyBackend)]
+    servers = [obj for obj in merged.values() if isinstance(obj, HaproxyServer)]
 
     return frontends, backends, servers
 
 
-def check_instance(frontends: list, backends: list, servers: list, args: Arguments):
-    """ Check HAproxy instance """
-    # pylint: disable=too-many-locals,too-many-branches,too-many-statements
+def get_all_stats(targets: list, statfilter: str = ""):
+    """ Query all targets concurrently and return the merged frontends, backends and servers """
 
-    # Initialize state and output string
-    output = ""
-    state = 0
+    if len(targets) == 1:
+        return get_haproxy_stats(targets[0][0], statfilter, targets[0][1])
 
-    output += (f'haproxy running with { len(frontends) } frontends, { len(backends) } backends, '
-               f'{ len(servers) } servers ')
+    with ThreadPoolExecutor(max_workers=len(targets)) as pool:
+        results = list(pool.map(lambda target: get_haproxy_stats(target[0], statfilter, target[1]), targets))
 
-    # Calculate total sessions
-    sessions = {'server_current': 0, 'server_total': 0, 'frontend_current': 0, 'backend_current': 0}
-    queues = {'server_current': 0}
-    errors = []
+    return merge_stats(results)
+
+
+def get_proxy_ids(args: Arguments, target: tuple, refresh: bool = False):
+    """ Return the proxy name to iid mapping, from the cache file unless refresh is requested """
+
+    # Keyed by socket only, worker pids change on every reload but the ids do not
+    socketfile, route = target
+    cachefile = os.path.join(args.statedir, re.sub(r'\W', '_', socketfile) + ".iids.json")
+
+    if not refresh:
+        try:
+            with open(cachefile, encoding="utf-8") as fobj:
+                return json.load(fobj)
+        except (OSError, ValueError):
+            pass
+
+    # Frontend and backend rows only, that is two rows per proxy whatever the number of servers
+    lines = haproxy_cmd_lines(f"{ route }show stat -1 { STAT_TYPE_FRONTEND | STAT_TYPE_BACKEND } -1\n", socketfile)
+    col_nr = get_stat_columns(lines, ['# pxname', 'iid'], socketfile)
+
+    proxy_ids = {}
+    for line in lines:
+        if line == "":
+            continue
+        row = line.split(",")
+        proxy_ids[row[col_nr['# pxname']]] = int(row[col_nr['iid']])
+
+    # Replace the cache file atomically, a failure only costs a full lookup next time
+    try:
+        os.makedirs(args.statedir, exist_ok=True)
+        with tempfile.NamedTemporaryFile("w", dir=args.statedir, delete=False, encoding="utf-8") as fobj:
+            json.dump(proxy_ids, fobj)
+        os.replace(fobj.name, cachefile)
+    except OSError:
+        pass
+
+    return proxy_ids
+
+
+def get_proxy_stats(args: Arguments, targets: list, proxy: str, stattype: int):
+    """ Fetch only the rows of the given types for one proxy, looked up by its iid """
+
+    # All processes run the same configuration, so the ids of the first one apply to all
+    for refresh in [False, True]:
+        proxy_ids = get_proxy_ids(args, targets[0], refresh)
+        if proxy not in proxy_ids:
+            continue
+
+        frontends, backends, servers = get_all_stats(targets, f'{ proxy_ids[proxy] } { stattype } -1')
+        rows = frontends + backends + servers
+
+        # A reload may have renumbered the proxies, only trust the reply if the name matches
+        if rows and all(object_key(obj)[0] == proxy for obj in rows):
+            return frontends, backends, servers
+
+    return [], [], []
+
+
+def object_key(obj):
+    """ Return the (proxy, server) key of an object, with FRONTEND or BACKEND as server for proxies """
+
+    if isinstance(obj, HaproxyServer):
+        return (obj.backend, obj.name)
+    if isinstance(obj, HaproxyFrontend):
+        return (obj.name, "FRONTEND")
+    return (obj.name, "BACKEND")
+
+
+def build_index(frontends: list, backends: list, servers: list):
+    """ Index all objects by (proxy, server) and group the servers by backend """
+
+    index = {object_key(obj): obj for obj in frontends + backends + servers}
 
-    # Loop through server objects
+    members = {}
     for server in servers:
-        sessions["server_current"] += server.sessions
-        sessions["server_total"] += server.sessionstotal
-        queues["server_current"] += server.queue
-        if server.state not in ["UP", 'no check'] and not server.state.startswith('UP'):
-            errors.append(f'Warn: server { server.name } is { server.state }')
-            state = set_state(1, state)
+        members.setdefault(server.backend, []).append(server)
 
-        if server.sessionlimit is not None:
-            # Calculate session thresholds for server
-            wthres = server.sessionlimit * (args.slim_warn / 100)
-            cthres = server.sessionlimit * (args.slim_crit / 100)
+    return index, members
 
-            if (server.sessions >= wthres) and (server.sessions < cthres):
-                errors.append(f'Warn: server { server.name } is using { server.sessions }/{ server.sessionlimit } sessions')
-                state = set_state(1, state)
 
-            if server.sessions >= cthres:
-                errors.append(f'Crit: server { server.name } is using { server.sessions }/{ server.sessionlimit } sessions')
-                state = set_state(2, state)
+def get_rates(args: Arguments, groups: list):
+    """ Return the per second rates of the counters of each (objects, counters) group since the last run """
 
-    output += f'and { sessions["server_current"] } sessions'
+    now = time.time()
+    statefile = os.path.join(args.statedir, re.sub(r'\W', '_', "_".join(args.socketfile)) + ".counters.json")
+    rates = {}
 
-    # Loop through frontend objects
-    for frontend in frontends:
-        sessions["frontend_current"] += frontend.sessions
+    # Concurrent checks against the same sockets share the state file, so read, update and write it under a lock
+    try:
+        os.makedirs(args.statedir, exist_ok=True)
+        with open(statefile + ".lock", "a", encoding="utf-8") as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
 
-        if frontend.state != "OPEN":
-            errors.append(f'Warn: frontend { frontend.name } is { frontend.state }')
-            state = set_state(1, state)
+            try:
+                with open(statefile, encoding="utf-8") as fobj:
+                    counters = json.load(fobj)
+            except (OSError, ValueError):
+                counters = {}
+
+            for objects, fields in groups:
+                for obj in objects:
+                    key = "/".join(object_key(obj))
+                    values = {field: getattr(obj, field) for field in fields}
+                    previous = counters.get(key)
+                    counters[key] = {'time': now, 'values': values}
+
+                    if previous is None or now <= previous['time']:
+                        continue
+
+                    rates[key] = {}
+                    for field in fields:
+                        new = values[field]
+                        old = previous['values'].get(field, new)
+                        # A counter going backwards means haproxy was reloaded and restarted from zero
+                        delta = new if new < old else new - old
+                        rates[key][field] = delta / (now - previous['time'])
+
+            counters = {key: item for key, item in counters.items() if item['time'] > now - RATES_MAX_AGE}
+
+            with tempfile.NamedTemporaryFile("w", dir=args.statedir, delete=False, encoding="utf-8") as fobj:
+                json.dump(counters, fobj)
+            os.replace(fobj.name, statefile)
+    except OSError as err:
+        exit_plugin(3, f'Unable to update counters in { statefile }: { err }', '')
+
+    return rates
+
+
+def format_rates(rates: dict, objects: list, fields: list, prefix: str = ""):
+    """ Return perfdata with the rates of the given counters summed over objects """
+
+    perfdata = ""
+
+    for field in fields:
+        values = [rates[key][field] for key in ["/".join(object_key(obj)) for obj in objects]
+                  if field in rates.get(key, {})]
+        if values:
+            perfdata += f' \'{ prefix }{ RATE_LABELS[field] }\'={ round(sum(values), 2) };;;;'
+
+    return perfdata
+
+
+def get_session_thresholds(sessionlimit: int, args: Arguments):
+    """ Return absolute WARN and CRIT session thresholds, or None if there is no session limit """
+
+    if sessionlimit is None:
+        return None, None
+
+    return sessionlimit * (args.slim_warn / 100), sessionlimit * (args.slim_crit / 100)
 
-        if frontend.sessionlimit is not None:
-            wthres = frontend.sessionlimit * (args.slim_warn / 100)
-            cthres = frontend.sessionlimit * (args.slim_crit / 100)
 
-            if (frontend.sessions >= wthres) and (frontend.sessions < cthres):
-                errors.append(f'Warn: frontend { frontend.name } is using { frontend.sessions }/{ frontend.sessionlimit } sessions')
-                state = set_state(1, state)
+def server_is_up(state: str):
+    """ Return True if a server state is healthy """
 
-            if frontend.sessions >= cthres:
-                errors.append(f'Crit: frontend { frontend.name } is using { frontend.sessions }/{ frontend.sessionlimit } sessions')
-                state = set_state(2, state)
+    return state in ["UP", 'no check'] or state.startswith('UP')
 
-    # Loop through backend objects
-    for backend in backends:
-        sessions["backend_current"] += backend.sessions
 
-        if backend.state != "UP":
-            errors.append(f'Warn: backend { backend.name } is { backend.state }')
+def check_objects(objects: list, kind: str, is_ok, args: Arguments):
+    """ Return state and error messages for objects in a bad state or close to their session limit """
+
+    state = 0
+    errors = []
+    warn = args.slim_warn / 100
+    crit = args.slim_crit / 100
+
+    # Single pass to pick out the few objects which need a message, in their original order
+    flagged = [obj for obj in objects
+               if not is_ok(obj.state) or (obj.sessionlimit is not None and obj.sessions >= obj.sessionlimit * warn)]
+
+    for obj in flagged:
+        if not is_ok(obj.state):
+            errors.append(f'Warn: { kind } { obj.name } is { obj.state }')
             state = set_state(1, state)
 
-        if backend.sessionlimit is not None:
-            wthres = backend.sessionlimit * (args.slim_warn / 100)
-            cthres = backend.sessionlimit * (args.slim_crit / 100)
+        if obj.sessionlimit is None:
+            continue
+
+        if obj.sessions >= obj.sessionlimit * crit:
+            errors.append(f'Crit: { kind } { obj.name } is using { obj.sessions }/{ obj.sessionlimit } sessions')
+            state = set_state(2, state)
+        elif obj.sessions >= obj.sessionlimit * warn:
+            errors.append(f'Warn: { kind } { obj.name } is using { obj.sessions }/{ obj.sessionlimit } sessions')
+            state = set_state(1, state)
+
+    return state, errors
+
 
-            if (backend.sessions >= wthres) and (backend.sessions < cthres):
-                errors.append(f'Warn: backend { backend.name } is using { backend.sessions }/{ backend.sessionlimit } sessions')
-                state = set_state(1, state)
+def check_instance(frontends: list, backends: list, servers: list, args: Arguments):
+    """ Check HAproxy instance """
 
-            if backend.sessions >= cthres:
-                errors.append(f'Crit: backend { backend.name } is using { backend.sessions }/{ backend.sessionlimit } sessions')
-                state = set_state(2, state)
+    # Calculate total sessions
+    sessions = sum(map(attrgetter('sessions'), servers))
+    sessionstotal = sum(map(attrgetter('sessionstotal'), servers))
+
+    output = (f'haproxy running with { len(frontends) } frontends, { len(backends) } backends, '
+              f'{ len(servers) } servers and { sessions } sessions')
+
+    state = 0
+    errors = []
+
+    for objects, kind, is_ok in [(servers, "server", server_is_up),
+                                 (frontends, "frontend", lambda state: state == "OPEN"),
+                                 (backends, "backend", lambda state: state == "UP")]:
+        newstate, newerrors = check_objects(objects, kind, is_ok, args)
+        state = set_state(newstate, state)
+        errors += newerrors
 
     output = f'{", ".join(errors + [output])}'
 
     if args.perfdata:
-        perfdata = (f' | \'sessions\'={ sessions["server_current"] };;;; '
-                    f'\'sessions_total\'={ sessions["server_total"] };;;; '
+        perfdata = (f' | \'sessions\'={ sessions };;;; '
+                    f'\'sessions_total\'={ sessionstotal };;;; '
                     f'\'frontends\'={ len(frontends) };;;; '
                     f'\'backends\'={ len(backends) };;;; '
-                    f'\'servers\'={ len(servers) };;;; ')
+                    f'\'servers\'={ len(servers) };;;;')
+        if args.rates:
+            backend_errors = ['connecterrors', 'responseerrors']
+            rates = get_rates(args, [(frontends, FRONTEND_RATES), (backends, backend_errors)])
+            perfdata += format_rates(rates, frontends, FRONTEND_RATES) + format_rates(rates, backends, backend_errors)
     else:
         perfdata = ''
 
     exit_plugin(state, output, perfdata)
 
 
-def check_frontend(frontends: list, args: Arguments):
-    """ Check single HAproxy frontend """
+def get_state(value: float, wthres: float, cthres: float):
+    """ Return 2 if value reaches cthres, 1 if it reaches wthres, 0 otherwise or without thresholds """
 
-    frontend = None
+    if cthres is not None and value >= cthres:
+        return 2
+    if wthres is not None and value >= wthres:
+        return 1
+    return 0
 
-    # Extract only the frontend we want to check
-    for item in frontends:
-        if item.name == args.frontend:
-            frontend = item
-            break
 
-    if frontend is None:
-        exit_plugin(3, f'Unable to find frontend { args.frontend }', '')
+def check_frontend(frontend: HaproxyFrontend, members: dict, rates: dict, args: Arguments, prefix: str):
+    """ Check single HAproxy frontend """
+    # pylint: disable=unused-argument,too-many-arguments
 
     # Calculate absolute WARN and CRIT thresholds for frontend
-    if frontend.sessionlimit is not None:
-        wthres = frontend.sessionlimit * (args.slim_warn / 100)
-        cthres = frontend.sessionlimit * (args.slim_crit / 100)
+    wthres, cthres = get_session_thresholds(frontend.sessionlimit, args)
 
-    if args.perfdata:
-        perfdata = (f' | \'sessions\'={ frontend.sessions }'
-                    f';{ wthres or "" };{ cthres or "" };0;{ frontend.sessionlimit or "" } '
-                    f'\'bytein\'={ frontend.bytein }B;;;; '
-                    f'\'byteout\'={ frontend.byteout }B;;;;')
-    else:
-        perfdata = ''
+    perfdata = (f' \'{ prefix }sessions\'={ frontend.sessions }'
+                f';{ wthres or "" };{ cthres or "" };0;{ frontend.sessionlimit or "" } '
+                f'\'{ prefix }bytein\'={ frontend.bytein }B;;;; '
+                f'\'{ prefix }byteout\'={ frontend.byteout }B;;;;')
+    perfdata += format_rates(rates, [frontend], FRONTEND_RATES, prefix)
 
     output = (f'HAProxy frontend { frontend.name } is { frontend.state }, '
               f'Sessions: { frontend.sessions }/{ frontend.sessionlimit or "-" }')
 
     if frontend.state != "OPEN":
         # Frontend is not OPEN, exit critical
+        return 2, output, perfdata
+
+    # Frontend sessions above WARN or CRIT threshold
+    return get_state(frontend.sessions, wthres, cthres), output, perfdata
+
+
+def check_backend(backend: HaproxyBackend, members: dict, rates: dict, args: Arguments, prefix: str):
+    """ Check single HAproxy backend, its session and queue saturation and the share of servers up """
+    # pylint: disable=too-many-arguments
+
+    servers = members.get(backend.name, [])
+    servers_up = sum(server_is_up(server.state) for server in servers)
+
+    wthres, cthres = get_session_thresholds(backend.sessionlimit, args)
+    up_wthres = len(servers) * args.up_warn / 100
+    up_cthres = len(servers) * args.up_crit / 100
+
+    perfdata = (f' \'{ prefix }sessions\'={ backend.sessions }'
+                f';{ wthres or "" };{ cthres or "" };0;{ backend.sessionlimit or "" } '
+                f'\'{ prefix }queue\'={ backend.queue };;;; '
+                f'\'{ prefix }servers_up\'={ servers_up };{ up_wthres }:;{ up_cthres }:;0;{ len(servers) } '
+                f'\'{ prefix }bytein\'={ backend.bytein }B;;;; '
+                f'\'{ prefix }byteout\'={ backend.byteout }B;;;;')
+    perfdata += format_rates(rates, [backend], BACKEND_RATES, prefix)
 
-        exit_plugin(2, output, perfdata)
+    output = (f'HAProxy backend { backend.name } is { backend.state }, '
+              f'Sessions: { backend.sessions }/{ backend.sessionlimit or "-" }, Queue: { backend.queue }, '
+              f'Servers up: { servers_up }/{ len(servers) }')
 
-    elif frontend.sessions >= cthres:
-        # Frontend sesions above CRIT threshold
+    if backend.state != "UP":
+        return 2, output, perfdata
 
-        exit_plugin(2, output, perfdata)
+    state = get_state(backend.sessions, wthres, cthres)
 
-    elif frontend.sessions >= wthres:
-        # Frontend sesions above WARN threshold
+    if servers_up < up_cthres:
+        state = set_state(2, state)
+    elif servers_up < up_wthres:
+        state = set_state(1, state)
 
-        exit_plugin(1, output, perfdata)
+    return state, output, perfdata
 
+
+def check_server(server: HaproxyServer, members: dict, rates: dict, args: Arguments, prefix: str):
+    """ Check single HAproxy server, its session and queue saturation """
+    # pylint: disable=unused-argument,too-many-arguments
+
+    wthres, cthres = get_session_thresholds(server.sessionlimit, args)
+
+    if server.queuelimit is not None:
+        q_wthres = server.queuelimit * (args.qlim_warn / 100)
+        q_cthres = server.queuelimit * (args.qlim_crit / 100)
     else:
-        # Everything OK
-        exit_plugin(0, output, perfdata)
+        q_wthres, q_cthres = None, None
+
+    perfdata = (f' \'{ prefix }sessions\'={ server.sessions }'
+                f';{ wthres or "" };{ cthres or "" };0;{ server.sessionlimit or "" } '
+                f'\'{ prefix }sessions_total\'={ server.sessionstotal }c;;;; '
+                f'\'{ prefix }queue\'={ server.queue }'
+                f';{ q_wthres or "" };{ q_cthres or "" };0;{ server.queuelimit or "" } '
+                f'\'{ prefix }bytein\'={ server.bytein }B;;;; '
+                f'\'{ prefix }byteout\'={ server.byteout }B;;;;')
+    perfdata += format_rates(rates, [server], BACKEND_RATES, prefix)
+
+    output = (f'HAProxy server { server.backend }/{ server.name } is { server.state }, '
+              f'Sessions: { server.sessions }/{ server.sessionlimit or "-" }, '
+              f'Queue: { server.queue }/{ server.queuelimit or "-" }')
+
+    if not server_is_up(server.state):
+        return 2, output, perfdata
+
+    state = get_state(server.sessions, wthres, cthres)
+    newstate = get_state(server.queue, q_wthres, q_cthres)
+    state = set_state(newstate, state)
+
+    return state, output, perfdata
+
+
+def target_key(mode: str, name: str):
+    """ Return the index key of a frontend, backend or <backend>/<server> target """
+
+    if mode == "server":
+        return tuple(name.split("/", 1))
+    return (name, mode.upper())
+
+
+def check_targets(index: dict, members: dict, args: Arguments):
+    """ Check every frontend, backend or server given on the command line and exit with the worst state """
+
+    names = getattr(args, args.mode)
+    keys = [target_key(args.mode, name) for name in names]
+    check, fields = {'frontend': (check_frontend, FRONTEND_RATES),
+                     'backend': (check_backend, BACKEND_RATES),
+                     'server': (check_server, BACKEND_RATES)}[args.mode]
+
+    # One pass over the state file for all targets
+    rates = {}
+    if args.perfdata and args.rates:
+        rates = get_rates(args, [([index[key] for key in keys if key in index], fields)])
+
+    state = 0
+    outputs = []
+    perfdata = ''
+
+    for name, key in zip(names, keys):
+        if key not in index:
+            newstate, output, newperfdata = 3, f'Unable to find { args.mode } { name }', ''
+        else:
+            # Prefix perfdata labels with the target name when there are several targets
+            prefix = f'{ name }_' if len(names) > 1 else ''
+            newstate, output, newperfdata = check(index[key], members, rates, args, prefix)
+
+        state = set_state(newstate, state)
+        outputs.append(output)
+        perfdata += newperfdata
+
+    if args.perfdata and perfdata:
+        perfdata = f' |{ perfdata }'
+    else:
+        perfdata = ''
+
+    exit_plugin(state, ", ".join(outputs), perfdata)
 
 
 def main():
@@ -402,12 +789,25 @@ def main():
     # Get Arguments
     args = get_args()
 
-    frontends, backends, servers = get_haproxy_stats(args.socketfile)
+    targets = get_stat_targets(args)
+
+    if args.mode in ["frontend", "backend", "server"]:
+        proxies = {target_key(args.mode, name)[0] for name in getattr(args, args.mode)}
+        stattype = {'frontend': STAT_TYPE_FRONTEND,
+                    'backend': STAT_TYPE_BACKEND | STAT_TYPE_SERVER,
+                    'server': STAT_TYPE_SERVER}[args.mode]
+
+        # A single proxy is fetched on its own, several proxies share one full read
+        if len(proxies) == 1:
+            frontends, backends, servers = get_proxy_stats(args, targets, proxies.pop(), stattype)
+        else:
+            frontends, backends, servers = get_all_stats(targets)
 
-    if args.mode == "frontend":
-        check_frontend(frontends, args)
+        index, members = build_index(frontends, backends, servers)
+        check_targets(index, members, args)
 
     elif args.mode == "instance":
+        frontends, backends, servers = get_all_stats(targets)
         check_instance(frontends, backends, servers, args)
 
     else:
@@ -34,19 +34,37 @@ import optparse
 import re
 import os
 import numbers
+import struct
+import io
+import contextlib
+import threading
+import calendar
 
-try:
-    import pymongo
-except ImportError as e:
-    print(e)
-    sys.exit(2)
+#
+# pymongo is only imported once a connection is needed, so --help, argument
+# errors and results served from --cache-ttl or --use-daemon do not pay for it
+#
+pymongo = None
+son = None
 
-# As of pymongo v 1.9 the SON API is part of the BSON package, therefore attempt
-# to import from there and fall back to pymongo in cases of older pymongo
-if pymongo.version >= "1.9":
-    import bson.son as son
-else:
-    import pymongo.son as son
+
+def import_pymongo():
+    global pymongo, son
+    if pymongo is not None:
+        return
+    try:
+        import pymongo as module
+    except ImportError as e:
+        print(e)
+        sys.exit(2)
+    pymongo = module
+
+    # As of pymongo v 1.9 the SON API is part of the BSON package, therefore attempt
+    # to import from there and fall back to pymongo in cases of older pymongo
+    if pymongo.version >= "1.9":
+        import bson.son as son
+    else:
+        import pymongo.son as son
 
 
 #
@@ -114,15 +132,82 @@ def check_levels(param, warning, critical, message, ok=[]):
         return 2
 
 
-def get_server_status(con):
+#
+# serverStatus documents shared by the actions of a single run, keyed by id()
+# of the connection
+#
+server_status_memo = {}
+
+#
+# actions that only need a serverStatus document and can be served from the
+# --cache-ttl cache, the delta actions time their samples from its localTime
+#
+SERVER_STATUS_ACTIONS = ['connections', 'memory', 'memory_mapped', 'queues', 'lock', 'current_lock', 'flushing', 'last_flush_time',
+                         'journal_commits_in_wl', 'journaled', 'write_data_files', 'opcounters', 'asserts', 'queries_per_second', 'page_faults']
+
+
+def get_server_status(con, fresh=False):
+    key = id(con)
+    if server_status_memo.get(key) is not None and not fresh:
+        return server_status_memo[key]
     try:
         set_read_preference(con.admin)
         data = con.admin.command(pymongo.son_manipulator.SON([('serverStatus', 1)]))
     except:
         data = con.admin.command(son.SON([('serverStatus', 1)]))
+    if key in server_status_memo:
+        server_status_memo[key] = data
     return data
 
 
+#
+# action name -> check, called with (con, options, warning, critical, conn_time, mongo_version)
+#
+ACTIONS = {
+    'connect': lambda con, o, w, c, t, v: check_connect(o.host, o.port, w, c, o.perf_data, o.user, o.passwd, t),
+    'connections': lambda con, o, w, c, t, v: check_connections(con, w, c, o.perf_data),
+    'replication_lag': lambda con, o, w, c, t, v: check_rep_lag(con, o.host_to_check, o.port_to_check, w, c, False, o.perf_data, o.max_lag, o.user, o.passwd),
+    'replication_lag_percent': lambda con, o, w, c, t, v: check_rep_lag(con, o.host_to_check, o.port_to_check, w, c, True, o.perf_data, o.max_lag, o.user, o.passwd,
+                                                                        o.ssl, o.insecure, o.ssl_ca_cert_file, o.cert_file),
+    'replication_lag_all': lambda con, o, w, c, t, v: check_rep_lag_all(con, w, c, o.perf_data, o.ssl, o.user, o.passwd, o.insecure, o.ssl_ca_cert_file, o.cert_file),
+    'replset_state': lambda con, o, w, c, t, v: check_replset_state(con, o.perf_data, w, c),
+    'replset_snapshot': lambda con, o, w, c, t, v: check_replset_snapshot(con, o.host, o.port, w, c, o.perf_data),
+    'memory': lambda con, o, w, c, t, v: check_memory(con, w, c, o.perf_data, o.mapped_memory, o.host),
+    'memory_mapped': lambda con, o, w, c, t, v: check_memory_mapped(con, w, c, o.perf_data),
+    'lock': lambda con, o, w, c, t, v: check_lock(con, w, c, o.perf_data, v),
+    'flushing': lambda con, o, w, c, t, v: check_flushing(con, w, c, True, o.perf_data),
+    'last_flush_time': lambda con, o, w, c, t, v: check_flushing(con, w, c, False, o.perf_data),
+    'index_miss_ratio': lambda con, o, w, c, t, v: index_miss_ratio(con, w, c, o.perf_data),
+    'databases': lambda con, o, w, c, t, v: check_databases(con, w, c, o.perf_data),
+    'collections': lambda con, o, w, c, t, v: check_collections(con, w, c, o.perf_data, o.workers, o.call_timeout),
+    'database_size': lambda con, o, w, c, t, v: (check_all_databases_size(con, w, c, o.perf_data, o.workers, o.call_timeout) if o.all_databases
+                                                 else check_database_size(con, o.database, w, c, o.perf_data)),
+    'database_indexes': lambda con, o, w, c, t, v: check_database_indexes(con, o.database, w, c, o.perf_data),
+    'collection_documents': lambda con, o, w, c, t, v: check_collection_documents(con, o.database, o.collection, w, c, o.perf_data,
+                                                                                  o.count_mode, o.query_filter, o.call_timeout),
+    'collection_indexes': lambda con, o, w, c, t, v: check_collection_indexes(con, o.database, o.collection, w, c, o.perf_data),
+    'collection_size': lambda con, o, w, c, t, v: check_collection_size(con, o.database, o.collection, w, c, o.perf_data),
+    'collection_storageSize': lambda con, o, w, c, t, v: check_collection_storageSize(con, o.database, o.collection, w, c, o.perf_data),
+    'collections_top': lambda con, o, w, c, t, v: check_collections_top(con, w, c, o.perf_data, o.sort_by, o.top, o.workers, o.call_timeout),
+    'queues': lambda con, o, w, c, t, v: check_queues(con, w, c, o.perf_data),
+    'oplog': lambda con, o, w, c, t, v: check_oplog(con, w, c, o.perf_data),
+    'journal_commits_in_wl': lambda con, o, w, c, t, v: check_journal_commits_in_wl(con, w, c, o.perf_data),
+    'write_data_files': lambda con, o, w, c, t, v: check_write_to_datafiles(con, w, c, o.perf_data),
+    'journaled': lambda con, o, w, c, t, v: check_journaled(con, w, c, o.perf_data),
+    'opcounters': lambda con, o, w, c, t, v: check_opcounters(con, o.host, o.port, w, c, o.perf_data),
+    'current_lock': lambda con, o, w, c, t, v: check_current_lock(con, o.host, o.port, w, c, o.perf_data),
+    'replica_primary': lambda con, o, w, c, t, v: check_replica_primary(con, o.host, w, c, o.perf_data, o.replicaset, v),
+    'page_faults': lambda con, o, w, c, t, v: check_page_faults(con, o.host, o.port, o.sample_time, w, c, o.perf_data),
+    'asserts': lambda con, o, w, c, t, v: check_asserts(con, o.host, o.port, w, c, o.perf_data),
+    'queries_per_second': lambda con, o, w, c, t, v: check_queries_per_second(con, o.host, o.port, o.query_type, w, c, o.perf_data),
+    'chunks_balance': lambda con, o, w, c, t, v: chunks_balance(con, o.database, o.collection, w, c, o.all_namespaces),
+    'connect_primary': lambda con, o, w, c, t, v: check_connect_primary(con, w, c, o.perf_data),
+    'collection_state': lambda con, o, w, c, t, v: check_collection_state(con, o.database, o.collection),
+    'row_count': lambda con, o, w, c, t, v: check_row_count(con, o.database, o.collection, w, c, o.perf_data, o.count_mode, o.query_filter, o.call_timeout),
+    'replset_quorum': lambda con, o, w, c, t, v: check_replset_quorum(con, o.perf_data),
+}
+
+
 def main(argv):
     p = optparse.OptionParser(conflict_handler="resolve", description="This Nagios plugin checks the health of mongodb.")
 
@@ -135,20 +220,45 @@ def main(argv):
     p.add_option('-W', '--warning', action='store', dest='warning', default=None, help='The warning threshold you want to set')
     p.add_option('-C', '--critical', action='store', dest='critical', default=None, help='The critical threshold you want to set')
     p.add_option('-A', '--action', action='store', type='choice', dest='action', default='connect', help='The action you want to take',
-                 choices=['connect', 'connections', 'replication_lag', 'replication_lag_percent', 'replset_state', 'memory', 'memory_mapped', 'lock',
-                          'flushing', 'last_flush_time', 'index_miss_ratio', 'databases', 'collections', 'database_size', 'database_indexes', 'collection_documents', 'collection_indexes', 'collection_size',
-                          'collection_storageSize', 'queues', 'oplog', 'journal_commits_in_wl', 'write_data_files', 'journaled', 'opcounters', 'current_lock', 'replica_primary',
-                          'page_faults', 'asserts', 'queries_per_second', 'page_faults', 'chunks_balance', 'connect_primary', 'collection_state', 'row_count', 'replset_quorum'])
+                 choices=list(ACTIONS))
+    p.add_option('--actions', action='store', type='string', dest='actions', default=None,
+                 help='Comma separated list of actions to run against a single connection and serverStatus, e.g. connections,queues:10:30 (optional action:warning:critical)')
+    p.add_option('--cache-ttl', action='store', type='int', dest='cache_ttl', default=0,
+                 help='Share serverStatus between checks of the same host:port for this many seconds (serverStatus only actions)')
+    p.add_option('--daemon', action='store', type='string', dest='daemon', default=None, metavar='SOCKET',
+                 help='Run as a resident daemon answering checks on this unix socket, keeping connections open')
+    p.add_option('--use-daemon', action='store', type='string', dest='use_daemon', default=None, metavar='SOCKET',
+                 help='Forward this check to the daemon listening on this unix socket (runs locally if it is not reachable)')
+    p.add_option('--workers', action='store', type='int', dest='workers', default=8,
+                 help='Number of concurrent per-database commands (collections and database_size --all-databases)')
+    p.add_option('--call-timeout', action='store', type='float', dest='call_timeout', default=10,
+                 help='Timeout in seconds of each per-database or per-collection command')
+    p.add_option('--rate-window', action='store', type='float', dest='rate_window', default=0,
+                 help='Compute rates over the oldest stored sample at most this many seconds old instead of the previous one')
+    p.add_option('--rate-smoothing', action='store', type='float', dest='rate_smoothing', default=None,
+                 help='Smooth rates with an exponentially weighted moving average of this weight (0 < weight <= 1)')
+    p.add_option('--cluster', action='store_true', dest='cluster', default=False,
+                 help='Connect to a mongos and run the action(s) on every member of every shard')
+    p.add_option('--timeout', action='store', type='float', dest='timeout', default=30,
+                 help='Overall time limit in seconds, applied to server selection, connections, sockets and every command (members still running with --cluster are reported UNKNOWN)')
     p.add_option('--max-lag', action='store_true', dest='max_lag', default=False, help='Get max replication lag (for replication_lag action only)')
     p.add_option('--mapped-memory', action='store_true', dest='mapped_memory', default=False, help='Get mapped memory instead of resident (if resident memory can not be read)')
     p.add_option('-D', '--perf-data', action='store_true', dest='perf_data', default=False, help='Enable output of Nagios performance data')
     p.add_option('-d', '--database', action='store', dest='database', default='admin', help='Specify the database to check')
     p.add_option('--all-databases', action='store_true', dest='all_databases', default=False, help='Check all databases (action database_size)')
+    p.add_option('--all-namespaces', action='store_true', dest='all_namespaces', default=False, help='Report the most imbalanced of all sharded namespaces (action chunks_balance)')
     p.add_option('-s', '--ssl', dest='ssl', default=False, action='callback', callback=optional_arg(True), help='Connect using SSL')
     p.add_option('-r', '--replicaset', dest='replicaset', default=None, action='callback', callback=optional_arg(True), help='Connect to replicaset')
     p.add_option('-q', '--querytype', action='store', dest='query_type', default='query', help='The query type to check [query|insert|update|delete|getmore|command] from queries_per_second')
     p.add_option('-c', '--collection', action='store', dest='collection', default='admin', help='Specify the collection to check')
-    p.add_option('-T', '--time', action='store', type='int', dest='sample_time', default=1, help='Time used to sample number of pages faults')
+    p.add_option('--sort-by', action='store', type='choice', dest='sort_by', default='storageSize', choices=sorted(TOP_COLLECTIONS_FIELDS),
+                 help='What to rank collections by (action collections_top)')
+    p.add_option('--top', action='store', type='int', dest='top', default=10, help='How many collections to report (action collections_top)')
+    p.add_option('--count-mode', action='store', type='choice', dest='count_mode', default='estimated', choices=['estimated', 'exact'],
+                 help='Count documents from collection metadata (estimated) or by counting them (exact) (actions row_count and collection_documents)')
+    p.add_option('--filter', action='store', type='string', dest='query_filter', default=None,
+                 help='Only count documents matching this JSON query, bounded by --call-timeout (actions row_count and collection_documents)')
+    p.add_option('-T', '--time', action='store', type='int', dest='sample_time', default=1, help='Time used to sample number of pages faults when there is no previous sample')
     p.add_option('-M', '--mongoversion', action='store', type='choice', dest='mongo_version', default='2', help='The MongoDB version you are talking with, either 2 or 3',
       choices=['2','3'])
     p.add_option('-a', '--authdb', action='store', type='string', dest='authdb', default='admin', help='The database you want to authenticate against')
@@ -159,139 +269,391 @@ def main(argv):
     choices=['MONGODB-X509','SCRAM-SHA-256','SCRAM-SHA-1'])
     p.add_option('--disable_retry_writes', dest='retry_writes_disabled', default=False, action='callback', callback=optional_arg(True), help='Disable retryWrites feature')    
 
-    options, arguments = p.parse_args()
+    options, arguments = p.parse_args(argv)
+
+    if options.query_filter is not None:
+        from bson import json_util
+        try:
+            options.query_filter = json_util.loads(options.query_filter)
+        except ValueError as e:
+            p.error("invalid --filter: %s" % e)
+
+    if options.rate_smoothing is not None and not 0 < options.rate_smoothing <= 1:
+        p.error("--rate-smoothing must be greater than 0 and at most 1")
+    global rate_window, rate_smoothing, deadline
+    rate_window = options.rate_window
+    rate_smoothing = options.rate_smoothing
+    deadline = time.time() + options.timeout
+
+    if options.daemon:
+        if daemon_connections is not None:
+            return "--daemon can not be forwarded to a running daemon"
+        return run_daemon(options.daemon)
+    if options.use_daemon and daemon_connections is None:
+        code = forward_to_daemon(options.use_daemon, argv)
+        if code is not None:
+            return code
+
+    options.host_to_check = options.host_to_check or options.host
+    options.port_to_check = options.port_to_check or options.port
+
     host = options.host
-    host_to_check = options.host_to_check if options.host_to_check else options.host
     port = options.port
-    port_to_check = options.port_to_check if options.port_to_check else options.port
     user = options.user
     passwd = options.passwd
     authdb = options.authdb
 
-    query_type = options.query_type
-    collection = options.collection
-    sample_time = options.sample_time
-    if (options.action == 'replset_state'):
-        warning = str(options.warning or "")
-        critical = str(options.critical or "")
-    else:
-        warning = float(options.warning or 0)
-        critical = float(options.critical or 0)
-
     action = options.action
-    perf_data = options.perf_data
-    max_lag = options.max_lag
-    mongo_version = options.mongo_version
-    database = options.database
     ssl = options.ssl
     replicaset = options.replicaset
     insecure = options.insecure
     ssl_ca_cert_file = options.ssl_ca_cert_file
     cert_file = options.cert_file
     auth_mechanism = options.auth_mechanism
-    retry_writes_disabled = options.retry_writes_disabled    
+    retry_writes_disabled = options.retry_writes_disabled
+
+    if options.actions:
+        actions = []
+        for item in options.actions.split(','):
+            name = item.split(':')[0].strip()
+            if name not in p.get_option('--action').choices:
+                p.error("invalid action in --actions: %r" % name)
+            actions.append(item.strip())
+    else:
+        actions = [action]
 
-    if action == 'replica_primary' and replicaset is None:
+    action_names = [item.split(':')[0] for item in actions]
+    if 'replica_primary' in action_names and replicaset is None:
         return "replicaset must be passed in when using replica_primary check"
-    elif not action == 'replica_primary' and replicaset:
+    elif 'replica_primary' not in action_names and replicaset:
         return "passing a replicaset while not checking replica_primary does not work"
 
     #
-    # moving the login up here and passing in the connection
+    # serverStatus only actions can be served from a recent on-disk copy
+    # without connecting to MongoDB at all
     #
-    start = time.time()
-    err, con = mongo_connect(host, port, ssl, user, passwd, replicaset, authdb, insecure, ssl_ca_cert_file, cert_file, retry_writes_disabled=retry_writes_disabled)
-
-    if err != 0:
-        return err
-
-    # Autodetect mongo-version and force pymongo to let us know if it can connect or not.
-    err, mongo_version = check_version(con)
-    if err != 0:
-        return err
-
-    conn_time = time.time() - start
-
-    if action == "connections":
-        return check_connections(con, warning, critical, perf_data)
-    elif action == "replication_lag":
-        return check_rep_lag(con, host_to_check, port_to_check, warning, critical, False, perf_data, max_lag, user, passwd)
-    elif action == "replication_lag_percent":
-        return check_rep_lag(con, host_to_check, port_to_check, warning, critical, True, perf_data, max_lag, user, passwd, ssl, insecure, ssl_ca_cert_file, cert_file)
-    elif action == "replset_state":
-        return check_replset_state(con, perf_data, warning, critical)
-    elif action == "memory":
-        return check_memory(con, warning, critical, perf_data, options.mapped_memory, host)
-    elif action == "memory_mapped":
-        return check_memory_mapped(con, warning, critical, perf_data)
-    elif action == "queues":
-        return check_queues(con, warning, critical, perf_data)
-    elif action == "lock":
-        return check_lock(con, warning, critical, perf_data, mongo_version)
-    elif action == "current_lock":
-        return check_current_lock(con, host, port, warning, critical, perf_data)
-    elif action == "flushing":
-        return check_flushing(con, warning, critical, True, perf_data)
-    elif action == "last_flush_time":
-        return check_flushing(con, warning, critical, False, perf_data)
-    elif action == "index_miss_ratio":
-        index_miss_ratio(con, warning, critical, perf_data)
-    elif action == "databases":
-        return check_databases(con, warning, critical, perf_data)
-    elif action == "collections":
-        return check_collections(con, warning, critical, perf_data)
-    elif action == "oplog":
-        return check_oplog(con, warning, critical, perf_data)
-    elif action == "journal_commits_in_wl":
-        return check_journal_commits_in_wl(con, warning, critical, perf_data)
-    elif action == "database_size":
-        if options.all_databases:
-            return check_all_databases_size(con, warning, critical, perf_data)
+    use_cache = options.cache_ttl > 0 and not options.cluster and all(name in SERVER_STATUS_ACTIONS for name in action_names)
+    status = None
+    if use_cache:
+        status = read_server_status_cache(host, port, options.cache_ttl)
+
+    # a client reused by --daemon still carries the timeouts of the check that opened it
+    with deadline_timeout():
+        if status is not None:
+            con = None
+            conn_time = 0
+            mongo_version = int(status['version'].split('.')[0])
         else:
-            return check_database_size(con, database, warning, critical, perf_data)
-    elif action == "database_indexes":
-        return check_database_indexes(con, database, warning, critical, perf_data)
-    elif action == "collection_documents":
-        return check_collection_documents(con, database, collection, warning, critical, perf_data)
-    elif action == "collection_indexes":
-        return check_collection_indexes(con, database, collection, warning, critical, perf_data)
-    elif action == "collection_size":
-        return check_collection_size(con, database, collection, warning, critical, perf_data)
-    elif action == "collection_storageSize":
-        return check_collection_storageSize(con, database, collection, warning, critical, perf_data)
-    elif action == "journaled":
-        return check_journaled(con, warning, critical, perf_data)
-    elif action == "write_data_files":
-        return check_write_to_datafiles(con, warning, critical, perf_data)
-    elif action == "opcounters":
-        return check_opcounters(con, host, port, warning, critical, perf_data)
-    elif action == "asserts":
-        return check_asserts(con, host, port, warning, critical, perf_data)
-    elif action == "replica_primary":
-        return check_replica_primary(con, host, warning, critical, perf_data, replicaset, mongo_version)
-    elif action == "queries_per_second":
-        return check_queries_per_second(con, query_type, warning, critical, perf_data, mongo_version)
-    elif action == "page_faults":
-        check_page_faults(con, sample_time, warning, critical, perf_data)
-    elif action == "chunks_balance":
-        chunks_balance(con, database, collection, warning, critical)
-    elif action == "connect_primary":
-        return check_connect_primary(con, warning, critical, perf_data)
-    elif action == "collection_state":
-        return check_collection_state(con, database, collection)
-    elif action == "row_count":
-        return check_row_count(con, database, collection, warning, critical, perf_data)
-    elif action == "replset_quorum":
-        return check_replset_quorum(con, perf_data)
+            #
+            # moving the login up here and passing in the connection
+            #
+            start = time.time()
+            err, con = mongo_connect(host, port, ssl, user, passwd, replicaset, authdb, insecure, ssl_ca_cert_file, cert_file, retry_writes_disabled=retry_writes_disabled)
+
+            if err != 0:
+                return err
+
+            # Autodetect mongo-version and force pymongo to let us know if it can connect or not.
+            err, mongo_version = check_version(con)
+            if err != 0:
+                return err
+
+            conn_time = time.time() - start
+
+        server_status_memo[id(con)] = status
+        try:
+            if options.cluster:
+                return check_cluster(con, actions, options)
+
+            if options.actions:
+                return check_multiple(con, actions, options, conn_time, mongo_version)
+
+            warning, critical = parse_thresholds(action, options.warning, options.critical)
+            return run_action(action, con, options, warning, critical, conn_time, mongo_version)
+        finally:
+            data = server_status_memo.pop(id(con), None)
+            if use_cache and status is None and data is not None:
+                write_server_status_cache(host, port, data)
+
+
+def parse_thresholds(action, warning, critical):
+    if (action == 'replset_state'):
+        warning = str(warning or "")
+        critical = str(critical or "")
     else:
-        return check_connect(host, port, warning, critical, perf_data, user, passwd, conn_time)
+        warning = float(warning or 0)
+        critical = float(critical or 0)
+    return warning, critical
+
+
+def run_action(action, con, options, warning, critical, conn_time, mongo_version):
+    return ACTIONS[action](con, options, warning, critical, conn_time, mongo_version)
+
+
+STATE_NAMES = {0: "OK", 1: "WARNING", 2: "CRITICAL", 3: "UNKNOWN"}
+
+
+def worst_state(state, other):
+    """ Order states as CRITICAL > WARNING > UNKNOWN > OK """
+    order = [0, 3, 1, 2]
+    return max(state, other, key=lambda s: order.index(s) if s in order else 1)
+
+
+class ThreadOutput(object):
+    """ sys.stdout replacement writing to the buffer of the current thread, if it has one """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, data):
+        buf = getattr(self.local, 'buffer', None)
+        if buf is None:
+            return self.stream.write(data)
+        return buf.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def run_captured(func, *args, **kwargs):
+    """ Run a check function and return its exit code and what it printed, safe to use from several threads """
+    if not isinstance(sys.stdout, ThreadOutput):
+        sys.stdout = ThreadOutput(sys.stdout)
+    out = io.StringIO()
+    previous = getattr(sys.stdout.local, 'buffer', None)
+    sys.stdout.local.buffer = out
+    try:
+        code = func(*args, **kwargs)
+    except SystemExit as e:
+        code = e.code
+    finally:
+        sys.stdout.local.buffer = previous
+    if isinstance(code, SystemExit):
+        code = code.code
+    output = out.getvalue()
+    if code is None:
+        code = 0
+    elif not isinstance(code, int):
+        # sys.exit("message") prints the message and exits with 1
+        output += str(code) + "\n"
+        code = 1
+    return code, output
+
+
+def merge_results(results):
+    """ Merge (name, code, output) check results into one status line and perfdata """
+    state = 0
+    messages = []
+    perfdata = []
+    for name, code, output in results:
+        text, _, perf = output.partition("|")
+        text = " ".join(text.split())
+        for prefix in STATE_NAMES.values():
+            if text.startswith(prefix + " - "):
+                text = text[len(prefix) + 3:]
+                break
+        messages.append("%s: %s" % (name, text))
+        perfdata += ["%s_%s" % (re.sub(r'\W', '_', name), item) for item in perf.split()]
+        state = worst_state(state, code)
+
+    message = "%s - %s" % (STATE_NAMES.get(state, "UNKNOWN"), ", ".join(messages))
+    if perfdata:
+        message += " | " + " ".join(perfdata)
+    return state, message
+
+
+def check_multiple(con, actions, options, conn_time, mongo_version):
+    """ Run several actions against one connection, fetching serverStatus only once """
+    results = []
+    for item in actions:
+        thresholds = item.split(':')
+        action = thresholds[0]
+        warning, critical = parse_thresholds(action, *(thresholds[1:3] + [None, None])[:2])
+        code, output = run_captured(run_action, action, con, options, warning, critical, conn_time, mongo_version)
+        results.append((action, code, output))
+
+    state, message = merge_results(results)
+    print(message)
+    return state
+
+
+def check_cluster(con, actions, options):
+    """ Run the actions on every member of every shard known to the mongos con, concurrently and within --timeout """
+    import copy
+
+    members = []
+    for shard in con.config.shards.find():
+        # host is either "host:port" or "replicaset/host:port,host:port"
+        replicaset, _, hosts = shard['host'].rpartition('/')
+        for member in hosts.split(','):
+            members.append((shard['_id'], replicaset or None, member))
+
+    if not members:
+        print("UNKNOWN - No shard found in config.shards, is this a mongos?")
+        return 3
+
+    def check_member(replicaset, member):
+        mhost, _, mport = member.rpartition(':')
+        mport = int(mport or 27017)
+        err, mcon = mongo_connect(mhost, mport, options.ssl, options.user, options.passwd, None, options.authdb, options.insecure,
+                                  options.ssl_ca_cert_file, options.cert_file, retry_writes_disabled=options.retry_writes_disabled,
+                                  direct_connection=True)
+        if err != 0:
+            return err
+        start = time.time()
+        err, mongo_version = check_version(mcon)
+        if err != 0:
+            return err
+        conn_time = time.time() - start
+
+        member_options = copy.copy(options)
+        member_options.host = member_options.host_to_check = mhost
+        member_options.port = member_options.port_to_check = mport
+        member_options.replicaset = replicaset
+        server_status_memo[id(mcon)] = None
+        try:
+            if options.actions:
+                return check_multiple(mcon, actions, member_options, conn_time, mongo_version)
+            warning, critical = parse_thresholds(options.action, options.warning, options.critical)
+            return run_action(options.action, mcon, member_options, warning, critical, conn_time, mongo_version)
+        finally:
+            server_status_memo.pop(id(mcon), None)
+
+    results = {}
+
+    def run_member(name, replicaset, member):
+        with deadline_timeout():
+            results[name] = run_captured(check_member, replicaset, member)
+
+    # daemon threads, so a member that never answers does not keep the plugin from exiting
+    threads = []
+    for shard, replicaset, member in members:
+        name = "%s %s" % (shard, member)
+        thread = threading.Thread(target=run_member, args=(name, replicaset, member))
+        thread.daemon = True
+        thread.start()
+        threads.append((name, thread))
+
+    merged = []
+    for name, thread in threads:
+        thread.join(max(0, deadline - time.time()))
+        code, output = results.get(name, (3, "UNKNOWN - No answer within %ss" % options.timeout))
+        merged.append((name, code, output))
+
+    state, message = merge_results(merged)
+    print(message)
+    return state
+
+
+#
+# MongoClient per connection arguments, only set when running with --daemon
+#
+daemon_connections = None
+
+
+def run_daemon(socket_file):
+    """ Answer checks forwarded with --use-daemon, reusing MongoDB connections between them """
+    global daemon_connections
+    import json
+    import signal
+    import socketserver
+
+    def run_check(argv):
+        try:
+            code = main(argv)
+        except SystemExit as e:
+            code = e.code
+        if code is not None and not isinstance(code, int):
+            # sys.exit("message") writes the message to stderr and exits with 1
+            sys.stderr.write(str(code) + "\n")
+            code = 1
+        return code
+
+    class CheckHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            try:
+                argv = json.loads(self.rfile.readline().decode())
+            except ValueError:
+                return
+            err = io.StringIO()
+            with contextlib.redirect_stderr(err):
+                code, output = run_captured(run_check, argv)
+            reply = {'code': code, 'output': output, 'error': err.getvalue()}
+            self.wfile.write(json.dumps(reply).encode())
+
+    if os.path.exists(socket_file):
+        os.unlink(socket_file)
+    daemon_connections = {}
+    # checks share sys.stdout and the connections, so they are answered one at a time
+    server = socketserver.UnixStreamServer(socket_file, CheckHandler)
+    os.chmod(socket_file, 0o600)
+    # stopped by a service manager, leave through the same cleanup as ^C
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        server.server_close()
+        os.unlink(socket_file)
+        for con in daemon_connections.values():
+            con.close()
+        daemon_connections = None
+    return 0
+
 
+def forward_to_daemon(socket_file, argv):
+    """ Run the check in the --daemon listening on socket_file, None if it is not reachable """
+    import json
+    import socket
 
-def mongo_connect(host=None, port=None, ssl=False, user=None, passwd=None, replica=None, authdb="admin", insecure=False, ssl_ca_cert_file=None, ssl_cert=None, auth_mechanism=None, retry_writes_disabled=False):
+    try:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # a busy or hung daemon must not hold the check past --timeout
+        sock.settimeout(remaining_time())
+        sock.connect(socket_file)
+        sock.sendall((json.dumps(argv) + "\n").encode())
+        sock.shutdown(socket.SHUT_WR)
+        chunks = []
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            chunks.append(data)
+        sock.close()
+        reply = json.loads(b"".join(chunks).decode())
+    except socket.timeout:
+        # no time left to run the check here instead
+        sock.close()
+        print("UNKNOWN - No answer from the daemon on %s within the timeout" % socket_file)
+        return 3
+    except (IOError, OSError, ValueError):
+        return None
+
+    sys.stdout.write(reply['output'])
+    sys.stderr.write(reply['error'])
+    return reply['code']
+
+
+def mongo_connect(host=None, port=None, ssl=False, user=None, passwd=None, replica=None, authdb="admin", insecure=False, ssl_ca_cert_file=None, ssl_cert=None, auth_mechanism=None, retry_writes_disabled=False, direct_connection=False):
+    import_pymongo()
     from pymongo.errors import ConnectionFailure
     from pymongo.errors import PyMongoError
     import ssl as SSL
 
+    key = (host, port, ssl, user, passwd, replica, authdb, insecure, ssl_ca_cert_file, ssl_cert, auth_mechanism, retry_writes_disabled,
+           direct_connection)
+    if daemon_connections is not None and key in daemon_connections:
+        con = daemon_connections[key]
+        try:
+            con.admin.command("ping")
+            return 0, con
+        except Exception:
+            # connection went bad, open a fresh one below
+            del daemon_connections[key]
+            con.close()
+
     con_args = dict()
 
     if ssl:
@@ -308,6 +670,20 @@ def mongo_connect(host=None, port=None, ssl=False, user=None, passwd=None, repli
     if retry_writes_disabled:
         con_args['retryWrites'] = False
 
+    # pymongo 4 discovers the whole replica set from a single host unless told otherwise
+    if direct_connection and getattr(pymongo, 'version_tuple', (0,)) >= (3, 11):
+        con_args['directConnection'] = True
+
+    if deadline is not None:
+        timeout_ms = max_time_ms(None)
+        con_args['serverSelectionTimeoutMS'] = timeout_ms
+        con_args['connectTimeoutMS'] = timeout_ms
+        if getattr(pymongo, 'version_tuple', (0,)) >= (4, 2):
+            # client side operation timeout, also sent to the server as maxTimeMS of every command
+            con_args['timeoutMS'] = timeout_ms
+        else:
+            con_args['socketTimeoutMS'] = timeout_ms
+
     try:
         # ssl connection for pymongo > 2.3
         if pymongo.version >= "2.3":
@@ -356,6 +732,10 @@ def mongo_connect(host=None, port=None, ssl=False, user=None, passwd=None, repli
             print("OK - State: 7 (Arbiter)")
             sys.exit(0)
         return exit_with_general_critical(e), None
+
+    # pymongo.timeout() only overrides the timeouts of a reused client from pymongo 4.2
+    if daemon_connections is not None and getattr(pymongo, 'version_tuple', (0,)) >= (4, 2):
+        daemon_connections[key] = con
     return 0, con
 
 
@@ -367,9 +747,24 @@ def exit_with_general_warning(e):
     return 1
 
 
+def is_timeout(e):
+    import concurrent.futures
+
+    if isinstance(e, concurrent.futures.TimeoutError):
+        return True
+    if pymongo is None:
+        return False
+    timeouts = tuple(getattr(pymongo.errors, name) for name in ('ServerSelectionTimeoutError', 'NetworkTimeout', 'ExecutionTimeout')
+                     if hasattr(pymongo.errors, name))
+    return isinstance(e, timeouts)
+
+
 def exit_with_general_critical(e):
     if isinstance(e, SystemExit):
         return e
+    elif is_timeout(e):
+        # server selection errors append the whole topology description
+        print("CRITICAL - MongoDB did not answer in time:", str(e).split(", Timeout:")[0])
     else:
         print("CRITICAL - General MongoDB Error:", e)
     return 2
@@ -494,10 +889,10 @@ def check_rep_lag(con, host, port, warning, critical, percent, perf_data, max_la
                             data = data + member['name'] + " lag=%d;" % replicationLag
                             maximal_lag = max(maximal_lag, replicationLag)
                     if percent:
-                        err, con = mongo_connect(primary_node['name'].split(':')[0], int(primary_node['name'].split(':')[1]), False, user, passwd)
+                        # con is connected to the primary here
+                        err, primary_timediff = get_oplog_window(con, primary_node['name'], ssl, user, passwd, insecure, ssl_ca_cert_file, cert_file)
                         if err != 0:
                             return err
-                        primary_timediff = replication_get_time_diff(con)
                         maximal_lag = int(float(maximal_lag) / float(primary_timediff) * 100)
                         message = "Maximal lag is " + str(maximal_lag) + " percents"
                         message += performance_data(perf_data, [(maximal_lag, "replication_lag_percent", warning, critical)])
@@ -526,10 +921,9 @@ def check_rep_lag(con, host, port, warning, critical, percent, perf_data, max_la
                 lag = float(optime_lag.seconds + optime_lag.days * 24 * 3600)
 
             if percent:
-                err, con = mongo_connect(primary_node['name'].split(':')[0], int(primary_node['name'].split(':')[1]), ssl, user, passwd, None, None, insecure, ssl_ca_cert_file, cert_file)
+                err, primary_timediff = get_oplog_window(con, primary_node['name'], ssl, user, passwd, insecure, ssl_ca_cert_file, cert_file)
                 if err != 0:
                     return err
-                primary_timediff = replication_get_time_diff(con)
                 if primary_timediff != 0:
                     lag = int(float(lag) / float(primary_timediff) * 100)
                 else:
@@ -570,10 +964,9 @@ def check_rep_lag(con, host, port, warning, critical, percent, perf_data, max_la
             optime_lag = abs(primary_node[1] - host_node["optimeDate"])
             lag = optime_lag.seconds
             if percent:
-                err, con = mongo_connect(primary_node['name'].split(':')[0], int(primary_node['name'].split(':')[1]))
+                err, primary_timediff = get_oplog_window(con, primary_node[0], ssl, user, passwd, insecure, ssl_ca_cert_file, cert_file)
                 if err != 0:
                     return err
-                primary_timediff = replication_get_time_diff(con)
                 lag = int(float(lag) / float(primary_timediff) * 100)
                 message = "Lag is " + str(lag) + " percents"
                 message += performance_data(perf_data, [(lag, "replication_lag_percent", warning, critical)])
@@ -585,6 +978,82 @@ def check_rep_lag(con, host, port, warning, critical, percent, perf_data, max_la
     except Exception as e:
         return exit_with_general_critical(e)
 
+def check_rep_lag_all(con, warning, critical, perf_data, ssl=None, user=None, passwd=None, insecure=None, ssl_ca_cert_file=None, cert_file=None):
+    """ Lag of every member from one replSetGetStatus, in seconds and in percent of the oplog window """
+    warning = warning or 600
+    critical = critical or 3600
+    try:
+        try:
+            rs_status = con.admin.command("replSetGetStatus")
+        except pymongo.errors.OperationFailure as e:
+            if ((e.code == None and str(e).find('failed: not running with --replSet"')) or (e.code == 76 and str(e).find('not running with --replSet"'))):
+                print("UNKNOWN - Not running with replSet")
+                return 3
+            raise
+
+        delays = {}
+        rs_conf = con.local.system.replset.find_one()
+        for member in rs_conf['members']:
+            delays[member['host']] = member.get('secondaryDelaySecs', member.get('slaveDelay')) or 0
+
+        primary_node = None
+        for member in rs_status['members']:
+            if member['stateStr'] == "PRIMARY":
+                primary_node = member
+        if primary_node is None:
+            print("WARNING - No primary defined. In an election?")
+            return 1
+
+        err, oplog_window = get_oplog_window(con, primary_node['name'], ssl, user, passwd, insecure, ssl_ca_cert_file, cert_file)
+        if err != 0:
+            return err
+
+        maximal_lag = 0
+        lags = []
+        perfdata = []
+        for member in rs_status['members']:
+            if member['stateStr'] in ("PRIMARY", "ARBITER") or 'optimeDate' not in member:
+                continue
+            lag = max(0, (primary_node['optimeDate'] - member['optimeDate']).total_seconds() - delays.get(member['name'], 0))
+            lag_percent = int(lag / oplog_window * 100) if oplog_window else 0
+            maximal_lag = max(maximal_lag, lag)
+            lags.append("%s: %is (%i%%)" % (member['name'], lag, lag_percent))
+            label = re.sub(r'\W', '_', member['name'])
+            perfdata += [(int(lag), "%s_replication_lag" % label, warning, critical), (lag_percent, "%s_replication_lag_percent" % label)]
+
+        message = "Maximal lag is %i seconds" % maximal_lag
+        if lags:
+            message += ", " + ", ".join(lags)
+        message += performance_data(perf_data, perfdata)
+        return check_levels(maximal_lag, warning, critical, message)
+
+    except Exception as e:
+        return exit_with_general_critical(e)
+
+
+#
+# Oplog windows are shared for a minute between the checks of all members
+#
+OPLOG_WINDOW_TTL = 60
+
+
+def get_oplog_window(con, primary, ssl=None, user=None, passwd=None, insecure=None, ssl_ca_cert_file=None, cert_file=None):
+    """ Seconds covered by the oplog of the primary host:port, read from con when it is the primary """
+    phost, pport = primary.split(':')[0], int(primary.split(':')[1])
+    file_name = build_file_name(phost, pport, "oplog_window", "ring")
+    samples, rates = read_samples(file_name, 1)
+    if samples and time.time() - samples[-1][0] < OPLOG_WINDOW_TTL:
+        return 0, samples[-1][1]
+
+    if not con.admin.command("ismaster").get("ismaster"):
+        err, con = mongo_connect(phost, pport, ssl, user, passwd, None, "admin", insecure, ssl_ca_cert_file, cert_file)
+        if err != 0:
+            return err, None
+    window = replication_get_time_diff(con)
+    write_samples(file_name, [[time.time(), window]], None)
+    return 0, window
+
+
 #
 # Check the memory usage of mongo. Alerting on this may be hard to get right
 # because it'll try to get as much memory as it can. And that's probably
@@ -854,6 +1323,85 @@ def check_replset_state(con, perf_data, warning="", critical=""):
     except Exception as e:
         return exit_with_general_critical(e)
 
+def check_replset_snapshot(con, host, port, warning, critical, perf_data):
+    """ State, health, lag and ping of every member, quorum and primary changes from one replSetGetStatus """
+    warning = warning or 600
+    critical = critical or 3600
+    warning_states = [0, 3, 5, 9]
+    critical_states = [4, 6, 8, 10]
+    try:
+        try:
+            rs_status = con.admin.command("replSetGetStatus")
+        except pymongo.errors.OperationFailure as e:
+            if ((e.code == None and str(e).find('failed: not running with --replSet"')) or (e.code == 76 and str(e).find('not running with --replSet"'))):
+                print("UNKNOWN - Not running with replSet")
+                return 3
+            raise
+
+        members = rs_status['members']
+        primaries = [member for member in members if member['state'] == 1]
+        healthy = [member for member in members if member.get('health', 1) == 1]
+
+        state = 0
+        errors = []
+        if len(primaries) != 1:
+            state = 2
+            errors.append("%i primaries, cluster is not quorate" % len(primaries))
+        if len(healthy) * 2 <= len(members):
+            state = 2
+            errors.append("only %i of %i members healthy, no majority" % (len(healthy), len(members)))
+
+        # primary changes are tracked in a local file, not in MongoDB
+        primary = primaries[0]['name'] if len(primaries) == 1 else "None"
+        file_name = build_file_name(host, port, "last_primary", "state")
+        previous = read_state(file_name)
+        if previous is not None and previous != primary:
+            state = worst_state(state, 1)
+            errors.append("primary changed from %s to %s" % (previous, primary))
+        if previous != primary:
+            write_state(file_name, primary)
+
+        details = []
+        perfdata = []
+        maximal_lag = 0
+        for member in members:
+            label = re.sub(r'\W', '_', member['name'])
+            detail = "%s %s" % (member['name'], member.get('stateStr', state_text(member['state'])))
+            if member.get('health', 1) != 1 or member['state'] in critical_states:
+                state = 2
+                errors.append("%s is %s" % (member['name'], member.get('stateStr', state_text(member['state']))))
+            elif member['state'] in warning_states:
+                state = worst_state(state, 1)
+                errors.append("%s is %s" % (member['name'], member.get('stateStr', state_text(member['state']))))
+
+            perfdata += [(member['state'], "%s_state" % label), (int(member.get('health', 1)), "%s_health" % label)]
+            if primaries and member['state'] == 2 and 'optimeDate' in member:
+                lag = max(0, (primaries[0]['optimeDate'] - member['optimeDate']).total_seconds())
+                maximal_lag = max(maximal_lag, lag)
+                detail += " lag %is" % lag
+                perfdata.append((int(lag), "%s_lag" % label, warning, critical))
+            if 'pingMs' in member:
+                detail += " ping %ims" % member['pingMs']
+                perfdata.append((member['pingMs'], "%s_ping_ms" % label))
+            details.append(detail)
+
+        if maximal_lag >= critical:
+            state = 2
+            errors.append("maximal lag is %i seconds" % maximal_lag)
+        elif maximal_lag >= warning:
+            state = worst_state(state, 1)
+            errors.append("maximal lag is %i seconds" % maximal_lag)
+
+        message = "Replica set %s, primary %s, %i/%i members healthy, maximal lag %is" % (rs_status.get('set'), primary, len(healthy), len(members), maximal_lag)
+        message = ", ".join(errors + [message]) + ": " + ", ".join(details)
+        message += performance_data(perf_data, perfdata)
+        print("%s - %s" % (STATE_NAMES[state], message))
+        return state
+
+    except Exception as e:
+        return exit_with_general_critical(e)
+
+
 def state_is_worse(state, worst_state, warning, critical):
     if worst_state in critical:
         return False
@@ -900,7 +1448,7 @@ def check_databases(con, warning, critical, perf_data=None):
         return exit_with_general_critical(e)
 
 
-def check_collections(con, warning, critical, perf_data=None):
+def check_collections(con, warning, critical, perf_data=None, workers=8, call_timeout=10):
     try:
         try:
             set_read_preference(con.admin)
@@ -908,11 +1456,13 @@ def check_collections(con, warning, critical, perf_data=None):
         except:
             data = con.admin.command(son.SON([('listDatabases', 1)]))
 
-        count = 0
-        for db in data['databases']:
-            dbase = con[db['name']]
+        def count_collections(name):
+            dbase = con[name]
             set_read_preference(dbase)
-            count += len(dbase.collection_names())
+            return len(list_collection_names(dbase, call_timeout))
+
+        names = [db['name'] for db in data['databases']]
+        count = sum(map_concurrently(count_collections, names, workers, call_timeout))
 
         message = "Number of collections: %.0f" % count
         message += performance_data(perf_data, [(count, "collections", warning, critical, message)])
@@ -922,30 +1472,101 @@ def check_collections(con, warning, critical, perf_data=None):
         return exit_with_general_critical(e)
 
 
-def check_all_databases_size(con, warning, critical, perf_data):
+def check_all_databases_size(con, warning, critical, perf_data, workers=8, call_timeout=10):
     warning = warning or 100
     critical = critical or 1000
     try:
-        set_read_preference(con.admin)
-        all_dbs_data = con.admin.command(pymongo.son_manipulator.SON([('listDatabases', 1)]))
-    except:
-        all_dbs_data = con.admin.command(son.SON([('listDatabases', 1)]))
+        try:
+            set_read_preference(con.admin)
+            all_dbs_data = con.admin.command(pymongo.son_manipulator.SON([('listDatabases', 1)]))
+        except:
+            all_dbs_data = con.admin.command(son.SON([('listDatabases', 1)]))
 
-    total_storage_size = 0
-    message = ""
-    perf_data_param = [()]
-    for db in all_dbs_data['databases']:
-        database = db['name']
-        data = con[database].command('dbstats')
-        storage_size = round(data['storageSize'] / 1024 / 1024, 1)
-        message += "; Database %s size: %.0f MB" % (database, storage_size)
-        perf_data_param.append((storage_size, database + "_database_size"))
-        total_storage_size += storage_size
+        def dbstats(name):
+            return con[name].command('dbstats', maxTimeMS=max_time_ms(call_timeout))
+
+        names = [db['name'] for db in all_dbs_data['databases']]
+        all_stats = map_concurrently(dbstats, names, workers, call_timeout)
 
-    perf_data_param[0] = (total_storage_size, "total_size", warning, critical)
-    message += performance_data(perf_data, perf_data_param)
-    message = "Total size: %.0f MB" % total_storage_size + message
-    return check_levels(total_storage_size, warning, critical, message)
+        total_storage_size = 0
+        message = ""
+        perf_data_param = [()]
+        for database, data in zip(names, all_stats):
+            storage_size = round(data['storageSize'] / 1024 / 1024, 1)
+            message += "; Database %s size: %.0f MB" % (database, storage_size)
+            perf_data_param.append((storage_size, database + "_database_size"))
+            total_storage_size += storage_size
+
+        perf_data_param[0] = (total_storage_size, "total_size", warning, critical)
+        message += performance_data(perf_data, perf_data_param)
+        message = "Total size: %.0f MB" % total_storage_size + message
+        return check_levels(total_storage_size, warning, critical, message)
+    except Exception as e:
+        return exit_with_general_critical(e)
+
+
+def remaining_time(limit=None):
+    """ Seconds left before the --timeout deadline, at most limit """
+    left = limit
+    if deadline is not None:
+        left = max(0.001, deadline - time.time())
+        if limit is not None:
+            left = min(limit, left)
+    return left
+
+
+@contextlib.contextmanager
+def deadline_timeout():
+    """ Bound the MongoDB operations of the block by the --timeout deadline of the current check, in --daemon """
+    if daemon_connections is None or deadline is None:
+        yield
+        return
+    import_pymongo()
+    if not hasattr(pymongo, 'timeout'):
+        # before pymongo 4.2 clients are not reused, their own timeouts already follow the deadline
+        yield
+        return
+    with pymongo.timeout(remaining_time()):
+        yield
+
+
+def max_time_ms(limit):
+    """ maxTimeMS for a command allowed to run limit seconds, within the --timeout deadline """
+    return max(1, int(remaining_time(limit) * 1000))
+
+
+def map_concurrently(func, items, workers, timeout):
+    """ Call func on every item from a bounded thread pool, results come back in items order """
+    from concurrent.futures import ThreadPoolExecutor
+
+    def call(item):
+        # pymongo.timeout() does not follow into the worker threads
+        with deadline_timeout():
+            return func(item)
+
+    executor = ThreadPoolExecutor(max_workers=max(1, workers))
+    futures = []
+    try:
+        futures = [executor.submit(call, item) for item in items]
+        return [future.result(timeout=remaining_time(timeout)) for future in futures]
+    finally:
+        # drop the calls still queued once one of them failed or timed out
+        try:
+            executor.shutdown(wait=False, cancel_futures=True)
+        except TypeError:
+            # cancel_futures is new in python 3.9
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+
+def list_collection_names(db, call_timeout=None):
+    # collection_names() was removed in pymongo 4
+    if not hasattr(db, 'list_collection_names'):
+        return db.collection_names()
+    if call_timeout:
+        return db.list_collection_names(maxTimeMS=max_time_ms(call_timeout))
+    return db.list_collection_names()
 
 
 def check_database_size(con, database, warning, critical, perf_data):
@@ -1000,12 +1621,11 @@ def check_database_indexes(con, database, warning, critical, perf_data):
         return exit_with_general_critical(e)
 
 
-def check_collection_documents(con, database, collection, warning, critical, perf_data):
+def check_collection_documents(con, database, collection, warning, critical, perf_data, count_mode='estimated', query_filter=None, call_timeout=10):
     perfdata = ""
     try:
         set_read_preference(con.admin)
-        data = con[database].command('collstats', collection)
-        documents = data['count']
+        documents = count_documents(con[database][collection], count_mode, query_filter, call_timeout)
         if perf_data:
             perfdata += " | collection_documents=%i;%i;%i" % (documents, warning, critical)
 
@@ -1089,6 +1709,70 @@ def check_collection_size(con, database, collection, warning, critical, perf_dat
         return exit_with_general_critical(e)
 
 
+#
+# --sort-by of collections_top: field of $collStats storageStats, unit and default thresholds
+#
+TOP_COLLECTIONS_FIELDS = {
+    'size': ('size', 'MB', 100, 1000),
+    'storageSize': ('storageSize', 'MB', 100, 1000),
+    'indexes': ('totalIndexSize', 'MB', 100, 1000),
+    'documents': ('count', '', 1000000, 10000000),
+}
+
+
+def check_collections_top(con, warning, critical, perf_data, sort_by='storageSize', top=10, workers=8, call_timeout=10):
+    """ Largest collections of all databases by size, storage size, index size or documents, thresholds apply to the largest """
+    import heapq
+
+    field, unit, default_warning, default_critical = TOP_COLLECTIONS_FIELDS[sort_by]
+    warning = warning or default_warning
+    critical = critical or default_critical
+    time_limit_ms = max_time_ms(call_timeout)
+    try:
+        try:
+            set_read_preference(con.admin)
+            data = con.admin.command(pymongo.son_manipulator.SON([('listDatabases', 1)]))
+        except:
+            data = con.admin.command(son.SON([('listDatabases', 1)]))
+
+        def list_namespaces(name):
+            names = con[name].list_collection_names(filter={'type': 'collection'}, maxTimeMS=time_limit_ms)
+            return [(name, coll) for coll in names if not coll.startswith('system.')]
+
+        def collection_value(namespace):
+            database, collection = namespace
+            try:
+                # sharded collections return one document per shard
+                stats = con[database][collection].aggregate([{'$collStats': {'storageStats': {}}}], maxTimeMS=time_limit_ms)
+                value = sum(doc['storageStats'].get(field, 0) for doc in stats)
+            except pymongo.errors.OperationFailure as e:
+                # NamespaceNotFound: dropped since it was listed, timeouts and other failures must not hide a collection
+                if e.code != 26:
+                    raise
+                return 0
+            if unit == 'MB':
+                value = value / 1024.0 / 1024.0
+            return value
+
+        names = [db['name'] for db in data['databases']]
+        namespaces = [ns for found in map_concurrently(list_namespaces, names, workers, call_timeout) for ns in found]
+        values = map_concurrently(collection_value, namespaces, workers, call_timeout)
+        largest = heapq.nlargest(top, zip(values, namespaces))
+
+        if not largest:
+            print("OK - No collection found")
+            return 0
+
+        message = "Top %i of %i collections by %s: " % (len(largest), len(namespaces), sort_by)
+        message += ", ".join("%s.%s %.0f%s" % (database, collection, value, (" " + unit) if unit else "") for value, (database, collection) in largest)
+        message += performance_data(perf_data, [("%.2f" % value, re.sub(r'[^\w.]', '_', "%s.%s" % ns) + "_" + sort_by, warning, critical)
+                                                for value, ns in largest])
+        return check_levels(largest[0][0], warning, critical, message)
+
+    except Exception as e:
+        return exit_with_general_critical(e)
+
+
 def check_collection_storageSize(con, database, collection, warning, critical, perf_data):
     warning = warning or 100
     critical = critical or 1000
@@ -1113,61 +1797,40 @@ def check_collection_storageSize(con, database, collection, warning, critical, p
         return exit_with_general_critical(e)
 
 
-def check_queries_per_second(con, query_type, warning, critical, perf_data, mongo_version):
+QUERY_TYPES = ['insert', 'query', 'update', 'delete', 'getmore', 'command']
+
+
+def check_queries_per_second(con, host, port, query_type, warning, critical, perf_data):
+    """ Rates of all query types from the previous opcounters kept in a local file, thresholds apply to query_type """
     warning = warning or 250
     critical = critical or 500
 
-    if query_type not in ['insert', 'query', 'update', 'delete', 'getmore', 'command']:
+    if query_type not in QUERY_TYPES:
         return exit_with_general_critical("The query type of '%s' is not valid" % query_type)
 
     try:
-        db = con.local
         data = get_server_status(con)
 
-        # grab the count
-        num = int(data['opcounters'][query_type])
+        # grab the counts
+        counts = [int(data['opcounters'][name]) for name in QUERY_TYPES]
 
         # do the math
-        last_count = db.nagios_check.find_one({'check': 'query_counts'})
-        try:
-            ts = int(time.time())
-            diff_query = num - last_count['data'][query_type]['count']
-            diff_ts = ts - last_count['data'][query_type]['ts']
-
-            if diff_ts == 0:
-                message = "diff_query = " + str(diff_query) + " diff_ts = " + str(diff_ts)
-                return check_levels(0, warning, critical, message)
-
-            query_per_sec = float(diff_query) / float(diff_ts)
-
-            # update the count now
-            if mongo_version == 2:
-                db.nagios_check.update({u'_id': last_count['_id']}, {'$set': {"data.%s" % query_type: {'count': num, 'ts': int(time.time())}}})
-            else:
-                db.nagios_check.update_one({u'_id': last_count['_id']}, {'$set': {"data.%s" % query_type: {'count': num, 'ts': int(time.time())}}})
-
-            message = "Queries / Sec: %f" % query_per_sec
-            message += performance_data(perf_data, [(query_per_sec, "%s_per_sec" % query_type, warning, critical, message)])
-        except KeyError:
-            #
-            # since it is the first run insert it
-            query_per_sec = 0
+        err, delta = maintain_delta(counts, host, port, "queries_per_second", status_time(data))
+        if err != 0:
+            # since it is the first run nothing to compare with
             message = "First run of check.. no data"
-            if mongo_version == 2:
-                db.nagios_check.update({u'_id': last_count['_id']}, {'$set': {"data.%s" % query_type: {'count': num, 'ts': int(time.time())}}})
-            else:
-                db.nagios_check.update_one({u'_id': last_count['_id']}, {'$set': {"data.%s" % query_type: {'count': num, 'ts': int(time.time())}}})
+            return check_levels(0, warning, critical, message)
 
-        except TypeError:
-            #
-            # since it is the first run insert it
-            query_per_sec = 0
-            message = "First run of check.. no data"
-            if mongo_version == 2:
-                db.nagios_check.insert({'check': 'query_counts', 'data': {query_type: {'count': num, 'ts': int(time.time())}}})
-            else:
-                db.nagios_check.insert_one({'check': 'query_counts', 'data': {query_type: {'count': num, 'ts': int(time.time())}}})
+        if delta[0] == 0:
+            message = "diff_ts = 0"
+            return check_levels(0, warning, critical, message)
+
+        rates = dict((name, float(diff) / delta[0]) for name, diff in zip(QUERY_TYPES, delta[1:]))
+        query_per_sec = rates[query_type]
 
+        message = "Queries / Sec: %f" % query_per_sec
+        message += performance_data(perf_data, [(query_per_sec, "%s_per_sec" % query_type, warning, critical)] +
+                                    [(rates[name], "%s_per_sec" % name) for name in QUERY_TYPES if name != query_type])
         return check_levels(query_per_sec, warning, critical, message)
 
     except Exception as e:
@@ -1284,7 +1947,7 @@ def get_opcounters(data, opcounters_name, host, port):
         return 0, [0] * 100
     total_commands = insert + query + update + delete + getmore + command
     new_vals = [total_commands, insert, query, update, delete, getmore, command]
-    return  maintain_delta(new_vals, host, port, opcounters_name)
+    return  maintain_delta(new_vals, host, port, opcounters_name, status_time(data))
 
 
 def check_opcounters(con, host, port, warning, critical, perf_data):
@@ -1318,7 +1981,7 @@ def check_current_lock(con, host, port, warning, critical, perf_data):
     lockTime = float(data['globalLock']['lockTime'])
     totalTime = float(data['globalLock']['totalTime'])
 
-    err, delta = maintain_delta([totalTime, lockTime], host, port, "locktime")
+    err, delta = maintain_delta([totalTime, lockTime], host, port, "locktime", status_time(data))
     if err == 0:
         lock_percentage = delta[2] / delta[1] * 100     # lockTime/totalTime*100
         message = "Current Lock Percentage: %.2f%%" % lock_percentage
@@ -1328,28 +1991,6 @@ def check_current_lock(con, host, port, warning, critical, perf_data):
         return exit_with_general_warning("problem reading data from temp file")
 
 
-def check_page_faults(con, host, port, warning, critical, perf_data):
-    """ A function to get page_faults per second from the system"""
-    warning = warning or 10
-    critical = critical or 30
-    data = get_server_status(con)
-
-    try:
-        page_faults = float(data['extra_info']['page_faults'])
-    except:
-        # page_faults unsupported on the underlaying system
-        return exit_with_general_critical("page_faults unsupported on the underlaying system")
-
-    err, delta = maintain_delta([page_faults], host, port, "page_faults")
-    if err == 0:
-        page_faults_ps = delta[1] / delta[0]
-        message = "Page faults : %.2f ps" % page_faults_ps
-        message += performance_data(perf_data, [("%.2f" % page_faults_ps, "page_faults_ps", warning, critical)])
-        return check_levels(page_faults_ps, warning, critical, message)
-    else:
-        return exit_with_general_warning("problem reading data from temp file")
-
-
 def check_asserts(con, host, port, warning, critical, perf_data):
     """ A function to get asserts from the system"""
     warning = warning or 1
@@ -1365,7 +2006,7 @@ def check_asserts(con, host, port, warning, critical, perf_data):
     user = asserts['user']
     rollovers = asserts['rollovers']
 
-    err, delta = maintain_delta([regular, warning_asserts, msg, user, rollovers], host, port, "asserts")
+    err, delta = maintain_delta([regular, warning_asserts, msg, user, rollovers], host, port, "asserts", status_time(data))
 
     if err == 0:
         if delta[5] != 0:
@@ -1431,72 +2072,125 @@ def check_replica_primary(con, host, warning, critical, perf_data, replicaset, m
     return check_levels(primary_status, warning, critical, message)
 
 
-def check_page_faults(con, sample_time, warning, critical, perf_data):
+def check_page_faults(con, host, port, sample_time, warning, critical, perf_data):
+    """ Page faults per second since the previous run, only the first run samples for sample_time seconds """
     warning = warning or 10
     critical = critical or 20
     try:
-        try:
-            set_read_preference(con.admin)
-            data1 = con.admin.command(pymongo.son_manipulator.SON([('serverStatus', 1)]))
-            time.sleep(sample_time)
-            data2 = con.admin.command(pymongo.son_manipulator.SON([('serverStatus', 1)]))
-        except:
-            data1 = con.admin.command(son.SON([('serverStatus', 1)]))
-            time.sleep(sample_time)
-            data2 = con.admin.command(son.SON([('serverStatus', 1)]))
-
+        data = get_server_status(con)
         try:
             #on linux servers only
-            page_faults = (int(data2['extra_info']['page_faults']) - int(data1['extra_info']['page_faults'])) // sample_time
+            page_faults = int(data['extra_info']['page_faults'])
         except KeyError:
             print("WARNING - Can't get extra_info.page_faults counter from MongoDB")
             sys.exit(1)
 
+        err, delta = maintain_delta([page_faults], host, port, "page_faults", status_time(data))
+        if err == 0 and delta[0] > 0:
+            page_faults = int(delta[1] // delta[0])
+        elif con is None:
+            # served from --cache-ttl, no way to take a second sample
+            message = "First run of check.. no data"
+            return check_levels(0, warning, critical, message)
+        else:
+            # no previous sample to compare with yet
+            time.sleep(sample_time)
+            data = get_server_status(con, fresh=True)
+            page_faults = (int(data['extra_info']['page_faults']) - page_faults) // sample_time
+            maintain_delta([int(data['extra_info']['page_faults'])], host, port, "page_faults", status_time(data))
+
         message = "Page Faults: %i" % (page_faults)
 
         message += performance_data(perf_data, [(page_faults, "page_faults", warning, critical)])
-        check_levels(page_faults, warning, critical, message)
+        return check_levels(page_faults, warning, critical, message)
 
     except Exception as e:
-        exit_with_general_critical(e)
+        return exit_with_general_critical(e)
 
 
-def chunks_balance(con, database, collection, warning, critical):
+def chunks_balance(con, database, collection, warning, critical, all_namespaces=False):
     warning = warning or 10
     critical = critical or 20
     nsfilter = database + "." + collection
     try:
         try:
             set_read_preference(con.admin)
-            col = con.config.chunks
-            nscount = col.find({"ns": nsfilter}).count()
-            shards = col.distinct("shard")
+            config = con.config
+            shards = [shard['_id'] for shard in config.shards.find({}, {'_id': 1})]
+
+            # Since MongoDB 5.0 chunks reference their collection by uuid instead of ns
+            uuids = {}
+            for coll in config.collections.find({'dropped': {'$ne': True}}, {'_id': 1, 'uuid': 1}):
+                if coll.get('uuid') is not None:
+                    uuids[coll['uuid']] = coll['_id']
+
+            if all_namespaces:
+                match = {}
+            else:
+                match = {"$or": [{"ns": nsfilter}] + [{"uuid": uuid} for uuid, ns in uuids.items() if ns == nsfilter]}
+
+            # one pass over config.chunks for the chunk count of every namespace and shard
+            pipeline = [{"$match": match},
+                        {"$group": {"_id": {"ns": "$ns", "uuid": "$uuid", "shard": "$shard"}, "count": {"$sum": 1}}}]
+            chunks = {}
+            for doc in config.chunks.aggregate(pipeline):
+                ns = doc['_id'].get('ns') or uuids.get(doc['_id'].get('uuid'))
+                chunks.setdefault(ns, {})[doc['_id']['shard']] = doc['count']
 
         except:
             print("WARNING - Can't get chunks infos from MongoDB")
             sys.exit(1)
 
-        if nscount == 0:
-            print("WARNING - Namespace %s is not sharded" % (nsfilter))
-            sys.exit(1)
+        if not all_namespaces:
+            nscount = sum(chunks.get(nsfilter, {}).values())
+            if nscount == 0:
+                print("WARNING - Namespace %s is not sharded" % (nsfilter))
+                sys.exit(1)
 
-        avgchunksnb = nscount // len(shards)
-        warningnb = avgchunksnb * warning // 100
-        criticalnb = avgchunksnb * critical // 100
+            avgchunksnb = nscount // len(shards)
+            warningnb = avgchunksnb * warning // 100
+            criticalnb = avgchunksnb * critical // 100
 
-        for shard in shards:
-            delta = abs(avgchunksnb - col.find({"ns": nsfilter, "shard": shard}).count())
-            message = "Namespace: %s, Shard name: %s, Chunk delta: %i" % (nsfilter, shard, delta)
+            for shard in shards:
+                delta = abs(avgchunksnb - chunks[nsfilter].get(shard, 0))
+                message = "Namespace: %s, Shard name: %s, Chunk delta: %i" % (nsfilter, shard, delta)
 
-            if delta >= criticalnb and delta > 0:
-                print("CRITICAL - Chunks not well balanced " + message)
-                sys.exit(2)
-            elif delta >= warningnb  and delta > 0:
-                print("WARNING - Chunks not well balanced  " + message)
-                sys.exit(1)
+                if delta >= criticalnb and delta > 0:
+                    print("CRITICAL - Chunks not well balanced " + message)
+                    sys.exit(2)
+                elif delta >= warningnb  and delta > 0:
+                    print("WARNING - Chunks not well balanced  " + message)
+                    sys.exit(1)
+
+            print("OK - Chunks well balanced across shards")
+            sys.exit(0)
 
-        print("OK - Chunks well balanced across shards")
-        sys.exit(0)
+        # rank every sharded namespace by the state its largest chunk delta raises, then by that delta in percent
+        # of the average; namespaces with fewer chunks than shards can not be spread evenly and are left out
+        state = 0
+        imbalances = []
+        for ns, counts in chunks.items():
+            avgchunksnb = sum(counts.values()) // len(shards)
+            if avgchunksnb == 0:
+                continue
+            shard, delta = max(((shard, abs(avgchunksnb - counts.get(shard, 0))) for shard in shards), key=lambda x: x[1])
+            percent = delta * 100.0 / avgchunksnb
+            if delta > 0 and delta >= avgchunksnb * critical // 100:
+                nsstate = 2
+            elif delta > 0 and delta >= avgchunksnb * warning // 100:
+                nsstate = 1
+            else:
+                nsstate = 0
+            state = worst_state(state, nsstate)
+            imbalances.append((nsstate, percent, delta, ns, shard))
+
+        imbalances.sort(reverse=True)
+        message = "%i sharded namespaces" % len(chunks)
+        if imbalances:
+            message += ", most imbalanced: " + ", ".join("%s (shard %s, chunk delta %i, %.0f%%)" % (ns, shard, delta, percent)
+                                                         for nsstate, percent, delta, ns, shard in imbalances[:5])
+        print("%s - %s" % (STATE_NAMES[state], message))
+        sys.exit(state)
 
     except Exception as e:
         exit_with_general_critical(e)
@@ -1549,9 +2243,21 @@ def check_collection_state(con, database, collection):
         return exit_with_general_critical(e)
 
 
-def check_row_count(con, database, collection, warning, critical, perf_data):
+def count_documents(col, count_mode='estimated', query_filter=None, call_timeout=10):
+    """ Count from collection metadata unless an exact or filtered count is asked for """
+    time_limit_ms = max_time_ms(call_timeout)
+    if query_filter is not None or count_mode == 'exact':
+        if hasattr(col, 'count_documents'):
+            return col.count_documents(query_filter or {}, maxTimeMS=time_limit_ms)
+        return col.find(query_filter or {}).max_time_ms(time_limit_ms).count()
+    if hasattr(col, 'estimated_document_count'):
+        return col.estimated_document_count(maxTimeMS=time_limit_ms)
+    return col.count()
+
+
+def check_row_count(con, database, collection, warning, critical, perf_data, count_mode='estimated', query_filter=None, call_timeout=10):
     try:
-        count = con[database][collection].count()
+        count = count_documents(con[database][collection], count_mode, query_filter, call_timeout)
         message = "Row count: %i" % (count)
         message += performance_data(perf_data, [(count, "row_count", warning, critical)])
 
@@ -1561,14 +2267,14 @@ def check_row_count(con, database, collection, warning, critical, perf_data):
         return exit_with_general_critical(e)
 
 
-def build_file_name(host, port, action):
+def build_file_name(host, port, action, ext="data"):
     #done this way so it will work when run independently and from shell
     module_name = re.match('(.*//*)*(.*)\..*', __file__).group(2)
 
     if (port == 27017):
-        return "/tmp/" + module_name + "_data/" + host + "-" + action + ".data"
+        return "/tmp/" + module_name + "_data/" + host + "-" + action + "." + ext
     else:
-        return "/tmp/" + module_name + "_data/" + host + "-" + str(port) + "-" + action + ".data"
+        return "/tmp/" + module_name + "_data/" + host + "-" + str(port) + "-" + action + "." + ext
 
 
 def ensure_dir(f):
@@ -1577,60 +2283,189 @@ def ensure_dir(f):
         os.makedirs(d)
 
 
-def write_values(file_name, string):
-    f = None
+def read_state(file_name):
+    """ Return the text stored by write_state(), None if there is none """
     try:
-        f = open(file_name, 'w')
-    except IOError as e:
-        #try creating
-        if (e.errno == 2):
-            ensure_dir(file_name)
-            f = open(file_name, 'w')
-        else:
-            raise IOError(e)
-    f.write(string)
-    f.close()
+        with open(file_name, 'r') as f:
+            return f.read()
+    except (IOError, OSError):
+        return None
+
+
+def write_state(file_name, text):
+    return write_atomically(file_name, text.encode())
+
+
+def write_atomically(file_name, raw):
+    """ Replace file_name with raw, through a temporary file so concurrent checks never read a partial one """
+    import tempfile
+
+    ensure_dir(file_name)
+    fd, tmp_name = tempfile.mkstemp(dir=os.path.dirname(file_name))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(raw)
+        os.rename(tmp_name, file_name)
+    except Exception:
+        os.unlink(tmp_name)
+        raise
     return 0
 
 
-def read_values(file_name):
-    data = None
+def read_server_status_cache(host, port, ttl):
+    """ Return the cached serverStatus of host:port if younger than ttl seconds """
+    file_name = build_file_name(host, port, "serverStatus", "bson")
     try:
-        f = open(file_name, 'r')
-        data = f.read()
-        f.close()
-        return 0, data
-    except IOError as e:
-        if (e.errno == 2):
-            #no previous data
-            return 1, ''
-    except Exception as e:
-        return 2, None
-
-
-def calc_delta(old, new):
-    delta = []
-    if (len(old) != len(new)):
-        raise Exception("unequal number of parameters")
-    for i in range(0, len(old)):
-        val = float(new[i]) - float(old[i])
-        if val < 0:
-            val = new[i]
-        delta.append(val)
-    return 0, delta
-
-
-def maintain_delta(new_vals, host, port, action):
-    file_name = build_file_name(host, port, action)
-    err, data = read_values(file_name)
-    old_vals = data.split(';')
-    new_vals = [str(int(time.time()))] + new_vals
-    delta = None
+        with open(file_name, 'rb') as f:
+            if time.time() - os.fstat(f.fileno()).st_mtime > ttl:
+                return None
+            raw = f.read()
+        import bson
+        if hasattr(bson, 'decode'):
+            return bson.decode(raw)
+        return bson.BSON(raw).decode()
+    except Exception:
+        return None
+
+
+def write_server_status_cache(host, port, data):
+    """ Atomically replace the cached serverStatus of host:port """
+    import fcntl
+    import bson
+
+    file_name = build_file_name(host, port, "serverStatus", "bson")
+    ensure_dir(file_name)
     try:
-        err, delta = calc_delta(old_vals, new_vals)
-    except:
-        err = 2
-    write_res = write_values(file_name, ";" . join(str(x) for x in new_vals))
+        with open(file_name + ".lock", 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                # another check is already refreshing the cache
+                return 1
+            raw = bson.encode(data) if hasattr(bson, 'encode') else bson.BSON.encode(data)
+            write_atomically(file_name, raw)
+    except (IOError, OSError):
+        return 1
+    return 0
+
+
+#
+# Samples of the delta actions are kept per host/action in a small binary
+# ring: a header (magic, version, values per sample, samples) followed by
+# the samples, oldest first, each one a timestamp and the counter values.
+#
+SAMPLES_MAGIC = b"CMRB"
+SAMPLES_HEADER = struct.Struct("<4sBBH")
+SAMPLES_KEPT = 32
+
+#
+# time.time() by which the check must be done, set from --timeout by main()
+#
+deadline = None
+
+#
+# set from --rate-window and --rate-smoothing by main()
+#
+rate_window = 0
+rate_smoothing = None
+
+
+def read_samples(file_name, nb_values):
+    """ Return the samples and the smoothed rates stored in file_name """
+    try:
+        with open(file_name, 'rb') as f:
+            raw = f.read()
+        magic, version, nb, count = SAMPLES_HEADER.unpack_from(raw)
+    except (IOError, OSError, struct.error):
+        return [], None
+    if magic != SAMPLES_MAGIC or version != 1 or nb != nb_values:
+        return [], None
+
+    record = struct.Struct("<%id" % (nb_values + 1))
+    offset = SAMPLES_HEADER.size
+    samples = []
+    try:
+        for i in range(count):
+            samples.append(list(record.unpack_from(raw, offset)))
+            offset += record.size
+        if len(raw) > offset:
+            # the smoothed rates, stored as a record whose timestamp is unused
+            return samples, list(record.unpack_from(raw, offset))[1:]
+    except struct.error:
+        return [], None
+    return samples, None
+
+
+def write_samples(file_name, samples, rates):
+    """ Replace file_name with the samples and the smoothed rates """
+    nb_values = len(samples[0]) - 1
+    record = struct.Struct("<%id" % (nb_values + 1))
+    raw = SAMPLES_HEADER.pack(SAMPLES_MAGIC, 1, nb_values, len(samples))
+    raw += b"".join(record.pack(*sample) for sample in samples)
+    if rates is not None:
+        raw += record.pack(0, *rates)
+    return write_atomically(file_name, raw)
+
+
+def status_time(data):
+    """ Time a serverStatus document was taken, from its localTime, so that a cached copy keeps its own time """
+    local_time = data.get('localTime')
+    if local_time is None:
+        return time.time()
+    return calendar.timegm(local_time.utctimetuple()) + local_time.microsecond / 1000000.0
+
+
+def maintain_delta(new_vals, host, port, action, sample_time=None):
+    """ Store new_vals and return [seconds, delta of each value] against the oldest sample inside
+    the --rate-window (the previous sample by default). Counters that went down were reset, their
+    delta is their new value and older samples are dropped. With --rate-smoothing the deltas are
+    the exponentially weighted rates multiplied by the seconds. sample_time defaults to now; a
+    sample with the same time as the last one is not stored again and gets the last delta back. """
+    file_name = build_file_name(host, port, action, "ring")
+    samples, rates = read_samples(file_name, len(new_vals))
+    now = sample_time if sample_time is not None else time.time()
+    new_sample = [now] + [float(x) for x in new_vals]
+
+    # same serverStatus document as last time, served again from the --cache-ttl cache
+    unchanged = bool(samples) and samples[-1][0] == now
+    if unchanged:
+        new_sample = samples[-1]
+        samples = samples[:-1]
+
+    delta = None
+    err = 1
+    if samples and samples[-1][0] < now:
+        last = samples[-1]
+        if any(new < old for new, old in zip(new_sample[1:], last[1:])):
+            # counter reset, the history is of no use anymore
+            samples = []
+            delta = [now - last[0]] + [new if new < old else new - old for new, old in zip(new_sample[1:], last[1:])]
+        else:
+            base = last
+            for sample in samples:
+                if now - sample[0] <= rate_window:
+                    base = sample
+                    break
+            delta = [now - base[0]] + [new - old for new, old in zip(new_sample[1:], base[1:])]
+        err = 0
+
+        if rate_smoothing and unchanged and rates is not None:
+            # the stored rates already account for this sample
+            delta = [delta[0]] + [rate * delta[0] for rate in rates]
+        elif rate_smoothing:
+            new_rates = [d / delta[0] for d in delta[1:]]
+            if rates is not None:
+                new_rates = [rate_smoothing * new + (1 - rate_smoothing) * old for new, old in zip(new_rates, rates)]
+            rates = new_rates
+            delta = [delta[0]] + [rate * delta[0] for rate in rates]
+    else:
+        rates = None
+
+    if unchanged:
+        return err, delta
+
+    samples = (samples + [new_sample])[-SAMPLES_KEPT:]
+    write_res = write_samples(file_name, samples, rates if rate_smoothing else None)
     return err + write_res, delta
 
 